@@ -5,6 +5,7 @@ import gradio as gr
 
 from dataset.utils import list_all_files
 from tutorial_utils import Image2Text
+from inference import EncoderOutputCache, ResultStore, BatchingServer, QueueFullError, OrtSessionConfig, parse_mode, enable_compile_cache, needs_safetensors_copy, convert_to_safetensors
 
 
 def demo_process(input_img):
@@ -13,19 +14,94 @@ def demo_process(input_img):
     return '\n'.join(contents)
 
 
+def stream_demo_process(input_img):
+    global image_to_text
+    for contents, _, _ in image_to_text.stream_text(input_img):
+        yield '\n'.join(contents)
+
+
+def page_demo_process(input_img):
+    global image_to_text
+    results = image_to_text.get_page_texts(input_img, num_beams=4)
+    return '\n\n'.join('\n'.join(contents) for _, contents, _ in results if contents is not None)
+
+
+async def async_demo_process(input_img):
+    global server
+    try:
+        result = await server.submit(input_img)
+    except QueueFullError:
+        raise gr.Error("서버가 혼잡합니다. 잠시 후 다시 시도해 주세요.")
+    print(f"queue wait: {result.queue_wait:.3f}s, compute: {result.compute_time:.3f}s, batch size: {result.batch_size}")
+    return '\n'.join(result.contents)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--pretrained_path", type=str, default="models/donut_nougat_aug")
+    parser.add_argument("--encoder_cache_mb", type=int, default=0)
+    parser.add_argument("--result_cache_path", type=str, default=None)
+    parser.add_argument("--result_cache_mb", type=int, default=256)
+    parser.add_argument("--constrained_decoding", action="store_true")
+    parser.add_argument("--ort_config", type=str, default=None)
+    parser.add_argument("--early_exit", action="store_true")
+    parser.add_argument("--memory_budget_mb", type=int, default=None)
+    parser.add_argument("--inference_mode", type=str, default="fp32")
+    parser.add_argument("--fast_startup", action="store_true")
+    parser.add_argument("--artifact_dir", type=str, default=None)
+    parser.add_argument("--warmup_beams", type=int, nargs="+", default=[4])
+    parser.add_argument("--serve_mode", type=str, default="sync", choices=["sync", "async", "stream", "page"])
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--batch_window_ms", type=float, default=20)
+    parser.add_argument("--max_queue_size", type=int, default=64)
     args, _ = parser.parse_known_args()
+    if args.fast_startup and not args.artifact_dir and needs_safetensors_copy(args.pretrained_path):
+        parser.error("--fast_startup needs --artifact_dir to store the safetensors copy of a .bin checkpoint")
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    image_to_text = Image2Text(args.pretrained_path, device)
+    ort_config = OrtSessionConfig.from_yaml(args.ort_config) if args.ort_config else None
+    if args.artifact_dir:
+        enable_compile_cache(args.artifact_dir)
+        ort_config = ort_config or OrtSessionConfig()
+        ort_config.optimized_model_dir = ort_config.optimized_model_dir or os.path.join(args.artifact_dir, "ort")
+    model_path = args.pretrained_path
+    if args.fast_startup and args.artifact_dir:
+        model_path = convert_to_safetensors(model_path, args.artifact_dir)
+    encoder_cache = EncoderOutputCache(args.encoder_cache_mb * 1024 ** 2) if args.encoder_cache_mb > 0 else None
+    result_store = ResultStore(args.result_cache_path, args.pretrained_path, args.result_cache_mb * 1024 ** 2) if args.result_cache_path else None
+    image_to_text = Image2Text(
+        model_path,
+        device,
+        encoder_cache=encoder_cache,
+        result_store=result_store,
+        constrained_decoding=args.constrained_decoding,
+        ort_config=ort_config,
+        early_exit=args.early_exit,
+        memory_budget_mb=args.memory_budget_mb,
+        fast_startup=args.fast_startup,
+        **parse_mode(args.inference_mode),
+    )
+    if args.fast_startup or args.inference_mode != "fp32":
+        image_to_text.warmup(num_beams=tuple(args.warmup_beams))
+    print("startup: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in image_to_text.startup_times.items()))
+
+    if args.serve_mode == "async":
+        server = BatchingServer(
+            image_to_text,
+            num_beams=4,
+            max_batch_size=args.max_batch_size,
+            batch_window=args.batch_window_ms / 1000,
+            max_queue_size=args.max_queue_size,
+        )
     
+    serve_fns = {"sync": demo_process, "async": async_demo_process, "stream": stream_demo_process, "page": page_demo_process}
     demo = gr.Interface(
-        fn=demo_process,
+        fn=serve_fns[args.serve_mode],
         inputs="image",
         outputs="text",
         title=f"Donut 🍩",
         examples=list_all_files('sample'),
     )
-    demo.launch()
\ No newline at end of file
+    if args.serve_mode == "async":
+        demo.queue(default_concurrency_limit=args.max_queue_size)
+    demo.launch()
@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import queue
+import resource
+import argparse
+import itertools
+import numpy as np
+import multiprocessing as mp
+
+from dataset.utils import list_all_files
+
+
+def percentiles(values):
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def run_config(model_path, device, num_beams, batch_size, num_threads, ort_config_path, image_paths, warmup, repeat, result_queue):
+    import torch
+    from tutorial_utils import Image2Text
+    from inference.utils import sequence_lengths
+    from inference.ort_session import OrtSessionConfig
+
+    torch.set_num_threads(num_threads)
+    ort_config = OrtSessionConfig.from_yaml(ort_config_path) if ort_config_path else OrtSessionConfig()
+    ort_config.intra_op_num_threads = num_threads
+    image_to_text = Image2Text(model_path, device, ort_config=ort_config)
+    pad_token_id = image_to_text.processor.tokenizer.pad_token_id
+
+    def run_batch(batch_paths):
+        loaded = [image_to_text.load_img(path) for path in batch_paths]
+        pixel_values = torch.cat([pixel_values for _, pixel_values in loaded])
+        outputs = image_to_text.generate(pixel_values, num_beams)
+        image_to_text.batch_postprocessing(outputs, raise_errors=False)
+        # the decoder prompt token is not generated
+        return sum(sequence_lengths(outputs.sequences, pad_token_id)) - len(batch_paths)
+
+    batches = [image_paths[idx:idx + batch_size] for idx in range(0, len(image_paths), batch_size)]
+    for batch_paths in batches[:warmup]:
+        run_batch(batch_paths)
+
+    latencies, tokens = [], 0
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        for batch_paths in batches:
+            batch_started_at = time.perf_counter()
+            tokens += run_batch(batch_paths)
+            latencies.extend([time.perf_counter() - batch_started_at] * len(batch_paths))
+    elapsed = time.perf_counter() - started_at
+
+    result_queue.put({
+        "images": len(latencies),
+        "latency": percentiles(latencies),
+        "images_per_sec": len(latencies) / elapsed,
+        "tokens_per_sec": tokens / elapsed,
+        # ru_maxrss is in kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def wait_for_result(process, result_queue, timeout=None):
+    # a child that dies (bad model path, ORT load failure, OOM kill) never puts a result, so poll instead of blocking
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        try:
+            return result_queue.get(timeout=1)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            try:
+                return result_queue.get(timeout=1)
+            except queue.Empty:
+                return {"error": f"exited with code {process.exitcode}"}
+        if deadline is not None and time.monotonic() > deadline:
+            process.terminate()
+            return {"error": f"timed out after {timeout}s"}
+
+
+def benchmark(args):
+    image_paths = sorted(list_all_files(args.image_dir))
+    if args.max_images:
+        image_paths = image_paths[:args.max_images]
+
+    context = mp.get_context("spawn")
+    results = []
+    for model_path, num_beams, batch_size, num_threads in itertools.product(
+        args.model_paths, args.num_beams, args.batch_sizes, args.num_threads
+    ):
+        # every configuration runs in a fresh process so peak RSS and warm caches do not leak between runs
+        result_queue = context.Queue()
+        process = context.Process(
+            target=run_config,
+            args=(
+                model_path, args.device, num_beams, batch_size, num_threads, args.ort_config,
+                image_paths, args.warmup, args.repeat, result_queue,
+            ),
+        )
+        process.start()
+        result = wait_for_result(process, result_queue, args.timeout)
+        process.join()
+
+        result.update({
+            "model_path": model_path,
+            "runtime": "onnx" if ('onnx' in model_path) or ('quantized' in model_path) else "pytorch",
+            "num_beams": num_beams,
+            "batch_size": batch_size,
+            "num_threads": num_threads,
+        })
+        print(json.dumps(result, ensure_ascii=False))
+        results.append(result)
+    return results
+
+
+def config_key(result):
+    return result["model_path"], result["num_beams"], result["batch_size"], result["num_threads"]
+
+
+def check_regressions(results, baseline_path, max_regression):
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = {config_key(result): result for result in json.load(file)["results"]}
+
+    regressions = []
+    for result in results:
+        reference = baseline.get(config_key(result))
+        if reference is None or "error" in result:
+            continue
+        if result["latency"]["p95"] > reference["latency"]["p95"] * (1 + max_regression):
+            regressions.append(f"{config_key(result)}: p95 {reference['latency']['p95']:.3f}s -> {result['latency']['p95']:.3f}s")
+    return regressions
+
+# python benchmark.py --model_paths models/donut_nougat_aug models/donut_quantized \
+#                     --image_dir sample --num_beams 1 4 16 --batch_sizes 1 4 --num_threads 4 8 \
+#                     --output bench.json
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_paths", type=str, nargs="+", required=True)
+    parser.add_argument("--image_dir", type=str, default="sample")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_beams", type=int, nargs="+", default=[4])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1])
+    parser.add_argument("--num_threads", type=int, nargs="+", default=[os.cpu_count()])
+    parser.add_argument("--max_images", type=int, default=None)
+    parser.add_argument("--ort_config", type=str, default=None)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--max_regression", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=None)
+    args, _ = parser.parse_known_args()
+
+    results = benchmark(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"results": results}, file, indent=2, ensure_ascii=False)
+
+    failed = [result for result in results if "error" in result]
+    for result in failed:
+        print(f"failed: {config_key(result)}: {result['error']}")
+    regressions = check_regressions(results, args.baseline, args.max_regression) if args.baseline else []
+    for regression in regressions:
+        print(f"regression: {regression}")
+    if failed or regressions:
+        sys.exit(1)
@@ -0,0 +1,16 @@
+from .utils import content_hash
+from .scheduler import LengthPredictor, LengthBucketScheduler, greedy_generate
+from .cache import EncoderOutputCache, ResultStore, model_fingerprint
+from .serving import BatchingServer, ServedResult, QueueFullError
+from .pool import WorkerPool
+from .streaming import TokenQueueStreamer, IncrementalDecoder
+from .grammar import DonutGrammarLogitsProcessor
+from .profiling import StageProfiler, DecoderStepTimer, profile_stage, stage_totals
+from .preprocess import TensorPreprocessor
+from .ort_session import OrtSessionConfig, optimize_graphs
+from .split import SplitPipeline
+from .stopping import build_stopping_criteria, token_budgets, close_open_tags
+from .memory import KVCacheEstimator, MemoryPlanner, PeakMemoryMonitor, past_key_values_bytes
+from .modes import apply_inference_mode, bf16_supported, parse_mode
+from .startup import has_safetensors, needs_safetensors_copy, convert_to_safetensors, enable_compile_cache
+from .page import detect_problem_boxes, crop_boxes
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from .utils import content_hash
+
+
+class EncoderOutputCache:
+    def __init__(self, max_bytes=512 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def sizeof(tensor):
+        return tensor.element_size() * tensor.nelement()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, tensor):
+        size = self.sizeof(tensor)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.current_bytes -= self.sizeof(self.entries.pop(key))
+        while self.entries and self.current_bytes + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.current_bytes -= self.sizeof(evicted)
+        self.entries[key] = tensor
+        self.current_bytes += size
+
+    def clear(self):
+        self.entries.clear()
+        self.current_bytes = 0
+
+
+class ResultStore:
+    def __init__(self, db_path, model_path, max_bytes=256 * 1024 ** 2):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.model_fingerprint = model_fingerprint(model_path)
+        self.lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, model TEXT, seq TEXT, contents TEXT, size INTEGER, accessed REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self.connection.commit()
+        self.invalidate_stale()
+
+    def make_key(self, img_path, **settings):
+        if isinstance(img_path, np.ndarray):
+            image_key = content_hash(img_path)
+        else:
+            with open(img_path, 'rb') as file:
+                image_key = content_hash(file.read())
+        settings = json.dumps(settings, sort_keys=True)
+        return content_hash(f'{image_key}|{self.model_fingerprint}|{settings}'.encode())
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT seq, contents FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, key, seq, contents):
+        seq = json.dumps(seq, ensure_ascii=False)
+        contents = json.dumps(contents, ensure_ascii=False)
+        size = len(seq.encode()) + len(contents.encode())
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (key, self.model_fingerprint, seq, contents, size, time.time()),
+            )
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self.connection.execute("SELECT key, size FROM results ORDER BY accessed LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def invalidate_stale(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM results WHERE model != ?", (self.model_fingerprint,))
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM results")
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def model_fingerprint(model_path):
+    # path plus size/mtime of every checkpoint file, so re-training into the same directory invalidates old results
+    digest = [os.path.abspath(model_path)]
+    if os.path.isdir(model_path):
+        for root, _, files in sorted(os.walk(model_path)):
+            for file in sorted(files):
+                stat = os.stat(os.path.join(root, file))
+                digest.append(f'{os.path.relpath(os.path.join(root, file), model_path)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return content_hash('|'.join(digest).encode())
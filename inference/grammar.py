@@ -0,0 +1,112 @@
+import re
+import torch
+from transformers import LogitsProcessor
+
+
+class DonutGrammarLogitsProcessor(LogitsProcessor):
+    """
+    Masks tokens that can not lead to a sequence produced by DonutDataset.json2token:
+    <s_k>/</s_k> tags must be balanced and properly nested, and $...$ math spans must be closed before a tag or eos.
+    Circled choice numbers are left unconstrained, a stem may mention ① before the choice list starts.
+
+    Args:
+        tokenizer: tokenizer with the task tokens added by DonutDataset
+        prompt_length: number of decoder prompt tokens (the task start token) that are not part of the grammar
+        max_math_tokens: a math span open for longer than this may be ended by the enclosing close tag or eos,
+                         so a stray $ (e.g. a currency sign) prunes nothing instead of forcing a max_length run
+    """
+
+    def __init__(self, tokenizer, prompt_length=1, max_math_tokens=128):
+        self.prompt_length = prompt_length
+        self.max_math_tokens = max_math_tokens
+        self.eos_token_id = tokenizer.eos_token_id
+
+        added_vocab = tokenizer.get_added_vocab()
+        self.open_ids, self.close_ids = {}, {}
+        for token, idx in added_vocab.items():
+            match = re.fullmatch(r"<(/?)s_(.+)>", token)
+            if match:
+                (self.close_ids if match.group(1) else self.open_ids)[idx] = match.group(2)
+        self.close_id_for_key = {key: idx for idx, key in self.close_ids.items()}
+        self.open_ids = {idx: key for idx, key in self.open_ids.items() if key in self.close_id_for_key}
+        self.sep_id = added_vocab.get("<sep/>")
+
+        vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        self.dollar_toggle_ids = {idx for idx, token in enumerate(vocab) if token and token.count('$') % 2 == 1}
+        self.states = {}
+
+    def initial_state(self):
+        # (open tag stack, tokens since the math span opened or 0 outside one, closed any tag)
+        return (), 0, False
+
+    def advance(self, state, token_id):
+        stack, math_tokens, closed = state
+        if token_id in self.open_ids:
+            return stack + (self.open_ids[token_id],), math_tokens, closed
+        if token_id in self.close_ids:
+            # inside a math span this is only allowed once it ran past max_math_tokens, the tag abandons the span
+            return stack[:-1], 0, True
+        if token_id in self.dollar_toggle_ids:
+            return stack, 0 if math_tokens else 1, closed
+        return stack, math_tokens + 1 if math_tokens else 0, closed
+
+    def mask_key(self, state):
+        stack, math_tokens, closed = state
+        return stack, bool(math_tokens), math_tokens > self.max_math_tokens, closed
+
+    def row_state(self, row):
+        key = row.numpy().tobytes()
+        if key in self.states:
+            return self.states[key]
+        parent = self.states.get(row[:-1].numpy().tobytes())
+        if parent is not None and len(row) > self.prompt_length:
+            state = self.advance(parent, int(row[-1]))
+        else:
+            state = self.initial_state()
+            for token_id in row[self.prompt_length:].tolist():
+                state = self.advance(state, token_id)
+        return state
+
+    def allowed_mask(self, state, vocab_size, device):
+        stack, in_math, overdue, closed = state
+        structural = list(self.open_ids) + list(self.close_ids) + [self.eos_token_id]
+        if self.sep_id is not None:
+            structural.append(self.sep_id)
+
+        if not stack:
+            # outside every tag only a new tag, or eos once something was closed, is valid
+            mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+            mask[list(self.open_ids)] = True
+            if closed:
+                mask[self.eos_token_id] = True
+            return mask
+
+        mask = torch.ones(vocab_size, dtype=torch.bool, device=device)
+        mask[structural] = False
+        if in_math:
+            if overdue:
+                mask[self.close_id_for_key[stack[-1]]] = True
+                mask[self.eos_token_id] = True
+            return mask
+
+        mask[list(self.open_ids)] = True
+        mask[self.close_id_for_key[stack[-1]]] = True
+        if self.sep_id is not None:
+            mask[self.sep_id] = True
+        return mask
+
+    def __call__(self, input_ids, scores):
+        if not self.open_ids:
+            return scores
+        rows = input_ids.cpu()
+        states = {}
+        masks = {}
+        for idx, row in enumerate(rows):
+            state = self.row_state(row)
+            states[row.numpy().tobytes()] = state
+            key = self.mask_key(state)
+            if key not in masks:
+                masks[key] = self.allowed_mask(key, scores.shape[-1], scores.device)
+            scores[idx] = scores[idx].masked_fill(~masks[key], -float("inf"))
+        self.states = states
+        return scores
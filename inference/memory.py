@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+import torch
+
+
+def _value(config, *names, default=None):
+    for name in names:
+        value = getattr(config, name, None)
+        if value is not None:
+            return value
+    return default
+
+
+class KVCacheEstimator:
+    """
+    Estimates the decoder-side memory of VisionEncoderDecoderModel.generate for a batch:
+    self-attention key/value cache up to max_length, cross-attention key/value cache over the encoder tokens,
+    encoder hidden states expanded per beam and the per-step scores over the vocabulary.
+    Beam search reorders the cache every step, which briefly holds a second copy of it.
+    """
+
+    def __init__(self, config, dtype_bytes=4):
+        decoder, encoder = config.decoder, config.encoder
+        self.num_layers = _value(decoder, "decoder_layers", "num_hidden_layers")
+        self.d_model = _value(decoder, "d_model", "hidden_size")
+        self.vocab_size = decoder.vocab_size
+        self.encoder_hidden_size = encoder.hidden_size
+        self.dtype_bytes = dtype_bytes
+
+        image_size = encoder.image_size
+        height, width = (image_size, image_size) if isinstance(image_size, int) else image_size
+        downsample = encoder.patch_size * 2 ** (len(_value(encoder, "depths", default=[1])) - 1)
+        self.encoder_length = (height // downsample) * (width // downsample)
+
+    def estimate(self, batch_size, num_beams, max_length=2048):
+        rows = batch_size * num_beams
+        self_attention = 2 * self.num_layers * rows * max_length * self.d_model * self.dtype_bytes
+        cross_attention = 2 * self.num_layers * rows * self.encoder_length * self.d_model * self.dtype_bytes
+        encoder_states = rows * self.encoder_length * self.encoder_hidden_size * self.dtype_bytes
+        scores = 2 * rows * self.vocab_size * 4
+        kv_cache = self_attention + cross_attention
+        reorder = kv_cache if num_beams > 1 else 0
+        return {
+            "kv_cache": kv_cache,
+            "encoder_states": encoder_states,
+            "scores": scores,
+            "reorder": reorder,
+            "total": kv_cache + encoder_states + scores + reorder,
+        }
+
+
+class MemoryPlanner:
+    def __init__(self, estimator, budget_bytes, min_beams=1, max_length=2048):
+        self.estimator = estimator
+        self.budget_bytes = budget_bytes
+        self.min_beams = min_beams
+        self.max_length = max_length
+
+    def plan(self, batch_size, num_beams):
+        # give up batch size before beams, beams change the output and batch size only throughput
+        while self.estimator.estimate(batch_size, num_beams, self.max_length)["total"] > self.budget_bytes:
+            if batch_size > 1:
+                batch_size = max(1, batch_size // 2)
+            elif num_beams > self.min_beams:
+                num_beams = max(self.min_beams, num_beams // 2)
+            else:
+                break
+        return batch_size, num_beams
+
+
+def past_key_values_bytes(past_key_values):
+    if past_key_values is None:
+        return 0
+    if isinstance(past_key_values, torch.Tensor):
+        return past_key_values.element_size() * past_key_values.nelement()
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    if isinstance(past_key_values, (tuple, list)):
+        return sum(past_key_values_bytes(value) for value in past_key_values)
+    return 0
+
+
+def _rss_bytes():
+    with open("/proc/self/statm", "r") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakMemoryMonitor:
+    # CUDA peaks come from the allocator, CPU peaks from sampling RSS in a background thread
+    def __init__(self, device, interval=0.005):
+        self.cuda = str(device).startswith("cuda")
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self.running = False
+        self.thread = None
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, _rss_bytes())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+            self.baseline = torch.cuda.memory_allocated()
+        elif os.path.exists("/proc/self/statm"):
+            self.baseline = self.peak = _rss_bytes()
+            self.running = True
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            self.peak = torch.cuda.max_memory_allocated()
+        elif self.thread is not None:
+            self.running = False
+            self.thread.join()
+        return False
+
+    @property
+    def peak_delta(self):
+        return max(0, self.peak - self.baseline)
@@ -0,0 +1,57 @@
+import torch
+
+
+def bf16_supported(device):
+    if str(device).startswith("cuda"):
+        return torch.cuda.is_bf16_supported()
+    try:
+        with open("/proc/cpuinfo", "r") as file:
+            flags = file.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def apply_inference_mode(model, device, precision="fp32", compile=False, channels_last=False):
+    # wraps encoder/decoder forward in place so every caller (generate, encode, assisted decoding) picks the mode up
+    device_type = "cuda" if str(device).startswith("cuda") else "cpu"
+    encoder_forward = model.encoder.forward
+    decoder_forward = model.decoder.forward
+
+    if channels_last:
+        model.encoder.to(memory_format=torch.channels_last)
+        contiguous_forward = encoder_forward
+
+        def encoder_forward(pixel_values=None, **kwargs):
+            if pixel_values is not None:
+                pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
+            return contiguous_forward(pixel_values=pixel_values, **kwargs)
+
+    if precision == "bf16":
+        if bf16_supported(device):
+            encoder_forward = torch.autocast(device_type, dtype=torch.bfloat16)(encoder_forward)
+            decoder_forward = torch.autocast(device_type, dtype=torch.bfloat16)(decoder_forward)
+        else:
+            print(f"bf16 is not supported on {device}, running in fp32")
+
+    if compile:
+        encoder_forward = torch.compile(encoder_forward)
+        # the decoder sees a longer past every step, so compile for dynamic shapes instead of recompiling per length
+        decoder_forward = torch.compile(decoder_forward, dynamic=True)
+
+    model.encoder.forward = encoder_forward
+    model.decoder.forward = decoder_forward
+    return model
+
+
+def parse_mode(mode):
+    # "fp32", "bf16", "compile", "channels_last" or a "+" joined combination such as "bf16+compile"
+    parts = set(mode.split("+"))
+    unknown = parts - {"fp32", "bf16", "compile", "channels_last"}
+    if unknown:
+        raise ValueError(f"unknown inference mode: {', '.join(sorted(unknown))}")
+    return {
+        "precision": "bf16" if "bf16" in parts else "fp32",
+        "compile": "compile" in parts,
+        "channels_last": "channels_last" in parts,
+    }
@@ -0,0 +1,133 @@
+import os
+import json
+import glob
+import shutil
+import platform
+import yaml
+import onnxruntime as ort
+
+execution_modes = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+graph_optimization_levels = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+class OrtSessionConfig:
+    """
+    Session settings for the ONNX Runtime path of Image2Text.
+
+    Args:
+        intra_op_num_threads, inter_op_num_threads: ORT thread pools, None keeps the ORT default (all cores)
+        execution_mode: "sequential" or "parallel"
+        graph_optimization_level: "disable", "basic", "extended" or "all"
+        enable_cpu_mem_arena, enable_mem_pattern: ORT memory arena and allocation pattern planning
+        optimized_model_dir: if set, graphs are optimized once, saved there and later loaded without re-optimizing
+        offline_optimization_level: level the saved graphs are optimized to; "all" bakes provider and CPU specific
+                                    fused ops into the file, so the rest is left to graph_optimization_level at load time
+        use_io_binding: bind encoder outputs and past key values on device instead of copying through numpy
+        provider: ORT execution provider
+    """
+
+    def __init__(
+        self,
+        intra_op_num_threads=None,
+        inter_op_num_threads=None,
+        execution_mode="sequential",
+        graph_optimization_level="all",
+        enable_cpu_mem_arena=True,
+        enable_mem_pattern=True,
+        optimized_model_dir=None,
+        offline_optimization_level="extended",
+        use_io_binding=True,
+        provider="CPUExecutionProvider",
+    ):
+        self.intra_op_num_threads = intra_op_num_threads
+        self.inter_op_num_threads = inter_op_num_threads
+        self.execution_mode = execution_mode
+        self.graph_optimization_level = graph_optimization_level
+        self.enable_cpu_mem_arena = enable_cpu_mem_arena
+        self.enable_mem_pattern = enable_mem_pattern
+        self.optimized_model_dir = optimized_model_dir
+        self.offline_optimization_level = offline_optimization_level
+        self.use_io_binding = use_io_binding
+        self.provider = provider
+
+    @classmethod
+    def from_yaml(cls, path):
+        with open(path, 'r', encoding='utf-8') as file:
+            return cls(**(yaml.safe_load(file) or {}))
+
+    def session_options(self, graph_optimization_level=None):
+        options = ort.SessionOptions()
+        if self.intra_op_num_threads is not None:
+            options.intra_op_num_threads = self.intra_op_num_threads
+        if self.inter_op_num_threads is not None:
+            options.inter_op_num_threads = self.inter_op_num_threads
+        options.execution_mode = execution_modes[self.execution_mode]
+        options.graph_optimization_level = graph_optimization_levels[graph_optimization_level or self.graph_optimization_level]
+        options.enable_cpu_mem_arena = self.enable_cpu_mem_arena
+        options.enable_mem_pattern = self.enable_mem_pattern
+        return options
+
+    def from_pretrained_kwargs(self, model_path):
+        if self.optimized_model_dir is None:
+            return model_path, {
+                "session_options": self.session_options(),
+                "provider": self.provider,
+                "use_io_binding": self.use_io_binding,
+            }
+        # graphs in the cache are already optimized up to offline_optimization_level, only the remaining passes run at load time
+        return optimize_graphs(model_path, self), {
+            "session_options": self.session_options(),
+            "provider": self.provider,
+            "use_io_binding": self.use_io_binding,
+        }
+
+
+def _source_manifest(model_path, level, provider):
+    manifest = {
+        "graph_optimization_level": level,
+        "ort_version": ort.__version__,
+        "provider": provider,
+        "host": [platform.machine(), platform.processor()],
+        "files": {},
+    }
+    for onnx_path in sorted(glob.glob(os.path.join(model_path, "*.onnx"))):
+        stat = os.stat(onnx_path)
+        manifest["files"][os.path.basename(onnx_path)] = [stat.st_size, stat.st_mtime_ns]
+    return manifest
+
+
+def optimize_graphs(model_path, session_config):
+    cache_name = f"{os.path.basename(os.path.normpath(model_path))}-{session_config.provider}"
+    cache_dir = os.path.join(session_config.optimized_model_dir, cache_name)
+    manifest_path = os.path.join(cache_dir, "ort_cache_manifest.json")
+    level = session_config.offline_optimization_level
+    manifest = _source_manifest(model_path, level, session_config.provider)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            if json.load(file) == manifest:
+                return cache_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for file_name in os.listdir(model_path):
+        source = os.path.join(model_path, file_name)
+        if os.path.isfile(source) and not file_name.endswith(".onnx"):
+            shutil.copy2(source, os.path.join(cache_dir, file_name))
+
+    for file_name in manifest["files"]:
+        options = session_config.session_options(graph_optimization_level=level)
+        options.optimized_model_filepath = os.path.join(cache_dir, file_name)
+        # creating the session runs the optimizer and writes the optimized graph
+        ort.InferenceSession(os.path.join(model_path, file_name), options, providers=[session_config.provider])
+
+    with open(manifest_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    return cache_dir
@@ -0,0 +1,102 @@
+import numpy as np
+from PIL import Image
+
+
+def ink_mask(image, threshold=200):
+    if type(image) != np.ndarray:
+        image = np.asarray(image.convert("L") if isinstance(image, Image.Image) else Image.open(image).convert("L"))
+    elif image.ndim == 3:
+        image = np.asarray(Image.fromarray(image).convert("L"))
+    return image < threshold
+
+
+def find_gaps(profile, min_gap):
+    # runs of empty rows/columns strictly between two inked ones
+    inked = np.flatnonzero(profile)
+    if len(inked) == 0:
+        return []
+    jumps = np.flatnonzero(np.diff(inked) > min_gap)
+    return [(int(inked[idx]) + 1, int(inked[idx + 1])) for idx in jumps]
+
+
+def trim(mask, box):
+    x0, y0, x1, y1 = box
+    rows = np.flatnonzero(mask[y0:y1, x0:x1].any(axis=1))
+    cols = np.flatnonzero(mask[y0:y1, x0:x1].any(axis=0))
+    if len(rows) == 0:
+        return None
+    return x0 + int(cols[0]), y0 + int(rows[0]), x0 + int(cols[-1]) + 1, y0 + int(rows[-1]) + 1
+
+
+def xy_cut(mask, box, min_row_gap, min_col_gap, boxes, columns_first=False):
+    box = trim(mask, box)
+    if box is None:
+        return boxes
+    x0, y0, x1, y1 = box
+    region = mask[y0:y1, x0:x1]
+    row_gaps = find_gaps(region.any(axis=1), min_row_gap)
+    col_gaps = find_gaps(region.any(axis=0), min_col_gap)
+    if not row_gaps and not col_gaps:
+        boxes.append(box)
+        return boxes
+
+    if columns_first:
+        # on the page itself full-height gutters split columns before anything else, otherwise problems that line up
+        # across columns would come out row by row. bands above the columns (headers) are peeled off one at a time
+        if col_gaps:
+            edges = [x0] + [x0 + edge for gap in col_gaps for edge in gap] + [x1]
+            for idx in range(0, len(edges), 2):
+                xy_cut(mask, (edges[idx], y0, edges[idx + 1], y1), min_row_gap, min_col_gap, boxes)
+        else:
+            start, end = row_gaps[0]
+            xy_cut(mask, (x0, y0, x1, y0 + start), min_row_gap, min_col_gap, boxes)
+            xy_cut(mask, (x0, y0 + end, x1, y1), min_row_gap, min_col_gap, boxes, columns_first=True)
+        return boxes
+
+    # inside a column cut along the widest gap first
+    widest_row = max((end - start for start, end in row_gaps), default=0)
+    widest_col = max((end - start for start, end in col_gaps), default=0)
+    if widest_col > widest_row:
+        edges = [x0] + [x0 + edge for gap in col_gaps for edge in gap] + [x1]
+        children = [(edges[idx], y0, edges[idx + 1], y1) for idx in range(0, len(edges), 2)]
+    else:
+        edges = [y0] + [y0 + edge for gap in row_gaps for edge in gap] + [y1]
+        children = [(x0, edges[idx], x1, edges[idx + 1]) for idx in range(0, len(edges), 2)]
+    for child in children:
+        xy_cut(mask, child, min_row_gap, min_col_gap, boxes)
+    return boxes
+
+
+def detect_problem_boxes(image, threshold=200, min_row_gap=0.02, min_col_gap=0.03, min_size=0.02, min_thickness=0.005, padding=8):
+    """
+    Find problem regions on a rendered page with a recursive XY-cut over ink projection profiles.
+    Boxes are returned in reading order: header bands first, then column by column from left to right,
+    top to bottom inside each column.
+
+    Args:
+        threshold: grayscale value below which a pixel counts as ink
+        min_row_gap: smallest blank band (fraction of page height) that separates two problems;
+                     has to be wider than the line spacing inside a problem
+        min_col_gap: smallest blank band (fraction of page width) that separates two columns
+        min_size: boxes smaller than this (fraction of page height) in both directions are dropped,
+                  e.g. page numbers or stray marks
+        min_thickness: boxes thinner than this (fraction of page height) in either direction are dropped,
+                       e.g. column rules or underlines
+        padding: pixels of margin added around every box
+    """
+    mask = ink_mask(image, threshold)
+    height, width = mask.shape
+    boxes = xy_cut(mask, (0, 0, width, height), int(min_row_gap * height), int(min_col_gap * width), [], columns_first=True)
+    min_side = min_size * height
+    min_thickness = min_thickness * height
+    return [
+        (max(0, x0 - padding), max(0, y0 - padding), min(width, x1 + padding), min(height, y1 + padding))
+        for x0, y0, x1, y1 in boxes
+        if (x1 - x0 >= min_side or y1 - y0 >= min_side) and min(x1 - x0, y1 - y0) >= min_thickness
+    ]
+
+
+def crop_boxes(image, boxes):
+    if type(image) != np.ndarray:
+        image = np.asarray(image.convert("RGB") if isinstance(image, Image.Image) else Image.open(image).convert("RGB"))
+    return [np.ascontiguousarray(image[y0:y1, x0:x1]) for x0, y0, x1, y1 in boxes]
@@ -0,0 +1,205 @@
+import io
+import os
+import time
+import queue
+import threading
+import itertools
+import multiprocessing as mp
+from concurrent.futures import Future
+
+from .profiling import StageProfiler, stage_totals
+from .startup import needs_safetensors_copy, convert_to_safetensors
+
+
+def _worker_main(worker_id, model_path, device, num_threads, cpu_ids, profile, ort_options, startup_options, task_queue, result_queue):
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    if cpu_ids and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_ids)
+
+    import torch
+    import numpy as np
+    from PIL import Image
+    from tutorial_utils import Image2Text
+    from inference.ort_session import OrtSessionConfig
+
+    torch.set_num_threads(num_threads)
+    profiler = StageProfiler() if profile else None
+    ort_config = OrtSessionConfig(**dict(ort_options, intra_op_num_threads=num_threads, inter_op_num_threads=1))
+    image_to_text = Image2Text(
+        model_path, device, profiler=profiler, ort_config=ort_config, fast_startup=startup_options.get("fast_startup", False)
+    )
+    if startup_options.get("warmup_beams"):
+        image_to_text.warmup(num_beams=tuple(startup_options["warmup_beams"]))
+        if profiler is not None:
+            profiler.drain()
+    result_queue.put(("ready", worker_id, None))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        request_id, image_bytes, num_beams = task
+        result_queue.put(("started", request_id, worker_id))
+        started_at = time.perf_counter()
+        try:
+            img = np.asarray(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
+            contents, _, seq = image_to_text.get_text(img, num_beams=num_beams)
+            result = {"contents": contents, "seq": seq, "compute_time": time.perf_counter() - started_at, "worker": worker_id}
+            if profiler is not None:
+                result["stages"] = profiler.drain()
+            result_queue.put(("ok", request_id, result))
+        except Exception as e:
+            result_queue.put(("error", request_id, repr(e)))
+    result_queue.put(("stopped", worker_id, None))
+
+
+class WorkerPool:
+    def __init__(self, model_path, device="cpu", num_workers=2, threads_per_worker=None, num_beams=4, pin_cores=False, profile=False, ort_options=None, startup_options=None):
+        self.model_path = model_path
+        self.device = device
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        self.num_beams = num_beams
+        self.pin_cores = pin_cores
+        self.profiler = StageProfiler() if profile else None
+        self.ort_options = ort_options or {}
+        self.startup_options = startup_options or {}
+
+        self.context = mp.get_context("spawn")
+        self.task_queue = self.context.Queue()
+        self.result_queue = self.context.Queue()
+        self.processes = []
+        self.pending = {}
+        self.assigned = {}
+        self.ready_workers = set()
+        self.draining = False
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.collector = None
+
+    def prepare(self):
+        if self.ort_options.get("optimized_model_dir") and (('onnx' in self.model_path) or ('quantized' in self.model_path)):
+            from .ort_session import OrtSessionConfig, optimize_graphs
+            # optimize once here so the workers do not race on writing the same cache
+            optimize_graphs(self.model_path, OrtSessionConfig(**self.ort_options))
+        elif self.startup_options.get("fast_startup") and needs_safetensors_copy(self.model_path):
+            # workers load the converted copy, the served checkpoint itself is left as is
+            self.model_path = convert_to_safetensors(self.model_path, self.startup_options["artifact_dir"])
+
+    def start(self):
+        self.prepare()
+        for worker_id in range(self.num_workers):
+            cpu_ids = None
+            if self.pin_cores:
+                first = worker_id * self.threads_per_worker
+                cpu_ids = set(range(first, first + self.threads_per_worker))
+            process = self.context.Process(
+                target=_worker_main,
+                args=(
+                    worker_id, self.model_path, self.device, self.threads_per_worker, cpu_ids,
+                    self.profiler is not None, self.ort_options, self.startup_options, self.task_queue, self.result_queue,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def collect(self):
+        stopped = set()
+        while len(stopped) < self.num_workers:
+            try:
+                kind, key, payload = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                self.reap(stopped)
+                continue
+            if kind == "ready":
+                self.ready_workers.add(key)
+            elif kind == "started":
+                # payload is the worker now holding the request, None once it is handed off between stages
+                with self.lock:
+                    if key in self.pending and payload is not None:
+                        self.assigned[key] = payload
+                    else:
+                        self.assigned.pop(key, None)
+            elif kind == "stopped":
+                self.ready_workers.discard(key)
+                stopped.add(key)
+            else:
+                with self.lock:
+                    future = self.pending.pop(key, None)
+                    self.assigned.pop(key, None)
+                if future is None:
+                    continue
+                if kind == "ok":
+                    if "stages" in payload:
+                        self.profiler.add_records(payload["stages"])
+                        payload["stages"] = stage_totals(payload["stages"])
+                    future.set_result(payload)
+                else:
+                    future.set_exception(RuntimeError(payload))
+            self.reap(stopped)
+
+    def reap(self, stopped):
+        # a worker killed by the OS (e.g. the OOM killer) never sends "stopped", fail what it was holding
+        for worker_id, process in enumerate(self.processes):
+            if worker_id in stopped or process.is_alive():
+                continue
+            stopped.add(worker_id)
+            self.ready_workers.discard(worker_id)
+            with self.lock:
+                if self.alive:
+                    lost = [request_id for request_id, owner in self.assigned.items() if owner == worker_id]
+                else:
+                    # nobody is left to pick up the queued requests either
+                    lost = list(self.pending)
+                futures = [self.pending.pop(request_id) for request_id in lost if request_id in self.pending]
+                for request_id in lost:
+                    self.assigned.pop(request_id, None)
+            for future in futures:
+                future.set_exception(RuntimeError(f"worker {worker_id} exited with code {process.exitcode}"))
+
+    @property
+    def alive(self):
+        return any(process.is_alive() for process in self.processes)
+
+    @property
+    def healthy(self):
+        # dead workers are not respawned, so a replica missing one has to fail liveness and get restarted
+        return self.draining or all(process.is_alive() for process in self.processes)
+
+    @property
+    def ready(self):
+        return (
+            not self.draining
+            and len(self.ready_workers) == self.num_workers
+            and all(process.is_alive() for process in self.processes)
+        )
+
+    @property
+    def in_flight(self):
+        with self.lock:
+            return len(self.pending)
+
+    def submit(self, image_bytes, num_beams=None):
+        if self.draining:
+            raise RuntimeError("worker pool is draining")
+        future = Future()
+        request_id = next(self.request_ids)
+        with self.lock:
+            self.pending[request_id] = future
+        self.task_queue.put((request_id, image_bytes, num_beams or self.num_beams))
+        return future
+
+    def drain(self, timeout=60):
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,85 @@
+import torch
+import numpy as np
+from PIL import Image
+
+
+class TensorPreprocessor:
+    """
+    Single pass replacement for aspect_ratio_preserving_resize_and_crop followed by DonutProcessor.
+    Each image is resized once and written, already rescaled and normalized, into its slot of a float batch tensor
+    whose background is pre-filled with the normalized white value, so no padded RGB copy is ever built.
+
+    Args:
+        image_mean, image_std, rescale_factor: normalization of the DonutProcessor image processor
+        width, height: model input size
+        reuse_buffers: keep one output buffer and return views into it; the result is only valid until the next call
+    """
+
+    def __init__(self, image_mean, image_std, rescale_factor=1 / 255, width=480, height=480, device="cpu", reuse_buffers=False):
+        self.width = width
+        self.height = height
+        self.device = device
+        self.reuse_buffers = reuse_buffers
+        self.buffer = None
+
+        image_mean = torch.tensor(image_mean, dtype=torch.float32).view(3, 1, 1)
+        image_std = torch.tensor(image_std, dtype=torch.float32).view(3, 1, 1)
+        # (x * rescale_factor - mean) / std == x * scale - shift
+        self.scale = rescale_factor / image_std
+        self.shift = image_mean / image_std
+        self.background = (255 * self.scale - self.shift).expand(3, height, width)
+
+    @classmethod
+    def from_processor(cls, processor, **kwargs):
+        image_processor = processor.image_processor
+        return cls(image_processor.image_mean, image_processor.image_std, image_processor.rescale_factor, **kwargs)
+
+    def resized_size(self, width, height):
+        # same target size as aspect_ratio_preserving_resize_and_crop
+        width_ratio = width / self.width
+        height_ratio = height / self.height
+        if width > self.width and height > self.height:
+            if width_ratio > height_ratio:
+                return self.width, int(self.width / (width / height))
+            return int(self.height * (width / height)), self.height
+        if width > self.width:
+            return self.width, int(self.width / (width / height))
+        if height > self.height:
+            return int(self.height * (width / height)), self.height
+        return width, height
+
+    def open(self, img_path):
+        if type(img_path) == np.ndarray:
+            return Image.fromarray(img_path)
+        image = Image.open(img_path)
+        # let the JPEG decoder downscale by a power of two while decoding when the page is much larger than the target
+        image.draft("RGB", (self.width, self.height))
+        return image
+
+    def allocate(self, batch_size):
+        pin_memory = str(self.device).startswith("cuda")
+        if not self.reuse_buffers:
+            return torch.empty((batch_size, 3, self.height, self.width), dtype=torch.float32, pin_memory=pin_memory)
+        if self.buffer is None or self.buffer.shape[0] < batch_size:
+            self.buffer = torch.empty((batch_size, 3, self.height, self.width), dtype=torch.float32, pin_memory=pin_memory)
+        return self.buffer[:batch_size]
+
+    def __call__(self, img_paths):
+        pixel_values = self.allocate(len(img_paths))
+        images = []
+        for slot, img_path in zip(pixel_values, img_paths):
+            image = self.open(img_path)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            new_width, new_height = self.resized_size(*image.size)
+            if (new_width, new_height) != image.size:
+                image = image.resize((new_width, new_height), Image.LANCZOS)
+            images.append(image)
+
+            offset_x = (self.width - new_width) // 2
+            offset_y = (self.height - new_height) // 2
+            pixels = torch.from_numpy(np.asarray(image)).permute(2, 0, 1)
+            slot.copy_(self.background)
+            region = slot[:, offset_y:offset_y + new_height, offset_x:offset_x + new_width]
+            region.copy_(pixels).mul_(self.scale).sub_(self.shift)
+        return images, pixel_values.to(self.device, non_blocking=True)
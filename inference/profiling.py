@@ -0,0 +1,94 @@
+import time
+import threading
+import numpy as np
+from collections import deque, defaultdict
+from contextlib import contextmanager, nullcontext
+from transformers import LogitsProcessor
+
+
+class StageProfiler:
+    def __init__(self, callbacks=None, max_records=100000):
+        self.callbacks = list(callbacks or [])
+        self.records = deque(maxlen=max_records)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at, **fields)
+
+    def record(self, stage, duration, **fields):
+        record = {"stage": stage, "duration": duration, "timestamp": time.time(), **fields}
+        with self.lock:
+            self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+
+    def add_records(self, records):
+        for record in records:
+            self.record(**{key: value for key, value in record.items() if key != "timestamp"})
+
+    def drain(self):
+        with self.lock:
+            records = list(self.records)
+            self.records.clear()
+        return records
+
+    def summary(self):
+        with self.lock:
+            durations = defaultdict(list)
+            for record in self.records:
+                durations[record["stage"]].append(record["duration"])
+        return {
+            stage: {
+                "count": len(values),
+                "total": float(np.sum(values)),
+                "mean": float(np.mean(values)),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "p99": float(np.percentile(values, 99)),
+            }
+            for stage, values in durations.items()
+        }
+
+    def prometheus_text(self, prefix="donut"):
+        metric = f"{prefix}_stage_seconds"
+        lines = [f"# HELP {metric} Time spent in each Image2Text pipeline stage.", f"# TYPE {metric} summary"]
+        for stage, stats in sorted(self.summary().items()):
+            for quantile in (50, 95, 99):
+                lines.append(f'{metric}{{stage="{stage}",quantile="0.{quantile}"}} {stats[f"p{quantile}"]:.6f}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {stats["total"]:.6f}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {stats["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+def profile_stage(profiler, name, **fields):
+    return profiler.stage(name, **fields) if profiler is not None else nullcontext()
+
+
+def stage_totals(records):
+    totals = defaultdict(float)
+    for record in records:
+        totals[record["stage"]] += record["duration"]
+    totals["decoder_steps"] = sum(record["stage"] == "decoder_step" for record in records)
+    return dict(totals)
+
+
+class DecoderStepTimer(LogitsProcessor):
+    # logits processors run once per decoding step, so the time between calls is one decoder step
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.last_step_at = None
+
+    def reset(self):
+        self.last_step_at = time.perf_counter()
+
+    def __call__(self, input_ids, scores):
+        now = time.perf_counter()
+        if self.last_step_at is not None:
+            self.profiler.record("decoder_step", now - self.last_step_at, step=input_ids.shape[-1])
+        self.last_step_at = now
+        return scores
@@ -0,0 +1,166 @@
+import os
+import json
+import torch
+import numpy as np
+from types import SimpleNamespace
+from transformers import VisionEncoderDecoderModel
+
+from .utils import content_hash, sequence_lengths
+
+
+class LengthPredictor:
+    def __init__(self, cache_path=None, intercept=64.0, slope=4000.0, ink_threshold=128, min_history=16):
+        self.cache_path = cache_path
+        self.intercept = intercept
+        self.slope = slope
+        self.ink_threshold = ink_threshold
+        self.min_history = min_history
+        self.history = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as file:
+                self.history = json.load(file)
+        self.fit()
+
+    def ink_density(self, image):
+        gray = np.asarray(image.convert("L"))
+        return float((gray < self.ink_threshold).mean())
+
+    def fit(self):
+        if len(self.history) < self.min_history:
+            return
+        densities, lengths = zip(*self.history.values())
+        if np.ptp(densities) == 0:
+            return
+        self.slope, self.intercept = np.polyfit(densities, lengths, 1)
+
+    def predict(self, image, key=None):
+        key = key or content_hash(image)
+        if key in self.history:
+            return self.history[key][1]
+        return max(int(self.intercept + self.slope * self.ink_density(image)), 1)
+
+    def update(self, image, length, key=None, density=None):
+        key = key or content_hash(image)
+        density = self.ink_density(image) if density is None else density
+        self.history[key] = (density, int(length))
+
+    def save(self):
+        if not self.cache_path:
+            return
+        self.fit()
+        with open(self.cache_path, 'w', encoding='utf-8') as file:
+            json.dump(self.history, file)
+
+
+def _select_past(past_key_values, keep):
+    if hasattr(past_key_values, 'reorder_cache'):
+        past_key_values.reorder_cache(keep)
+        return past_key_values
+    return tuple(tuple(state.index_select(0, keep) for state in layer) for layer in past_key_values)
+
+
+@torch.no_grad()
+def greedy_generate(image_to_text, pixel_values, max_length=2048):
+    # greedy decoding that drops finished rows from the active batch instead of padding them to the end
+    model = image_to_text.model
+    tokenizer = image_to_text.processor.tokenizer
+    batch_size = pixel_values.shape[0]
+
+    if image_to_text.encoder_cache is not None:
+        encoder_hidden_states = image_to_text.encode(pixel_values).last_hidden_state
+    else:
+        encoder_hidden_states = model.encoder(pixel_values=pixel_values).last_hidden_state
+    if hasattr(model, 'enc_to_dec_proj'):
+        encoder_hidden_states = model.enc_to_dec_proj(encoder_hidden_states)
+
+    active = torch.arange(batch_size, device=pixel_values.device)
+    input_ids = image_to_text.decoder_input_ids.repeat(batch_size, 1)
+    tokens = [input_ids[0].tolist() for _ in range(batch_size)]
+    past_key_values = None
+
+    for _ in range(max_length - input_ids.shape[1]):
+        outputs = model.decoder(
+            input_ids=input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        logits = outputs.logits[:, -1, :]
+        logits[:, tokenizer.unk_token_id] = -float("inf")
+        if image_to_text.grammar is not None:
+            logits = image_to_text.grammar(torch.tensor([tokens[row] for row in active.tolist()]), logits)
+        next_tokens = logits.argmax(dim=-1)
+        past_key_values = outputs.past_key_values
+
+        for row, token in zip(active.tolist(), next_tokens.tolist()):
+            tokens[row].append(token)
+
+        unfinished = next_tokens != tokenizer.eos_token_id
+        if not unfinished.all():
+            keep = unfinished.nonzero().squeeze(1)
+            if keep.numel() == 0:
+                break
+            active = active[keep]
+            next_tokens = next_tokens[keep]
+            encoder_hidden_states = encoder_hidden_states[keep]
+            past_key_values = _select_past(past_key_values, keep)
+        input_ids = next_tokens[:, None]
+
+    sequences = torch.nn.utils.rnn.pad_sequence(
+        [torch.tensor(row) for row in tokens], batch_first=True, padding_value=tokenizer.pad_token_id
+    )
+    return SimpleNamespace(sequences=sequences)
+
+
+class LengthBucketScheduler:
+    def __init__(self, image_to_text, predictor=None, batch_size=8, bucket_width=128):
+        self.image_to_text = image_to_text
+        self.predictor = predictor or LengthPredictor()
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+
+    def make_buckets(self, predicted_lengths):
+        order = sorted(range(len(predicted_lengths)), key=lambda idx: predicted_lengths[idx])
+        buckets, current, current_key = [], [], None
+        for idx in order:
+            key = predicted_lengths[idx] // self.bucket_width
+            if current and (key != current_key or len(current) == self.batch_size):
+                buckets.append(current)
+                current = []
+            current.append(idx)
+            current_key = key
+        if current:
+            buckets.append(current)
+        return buckets
+
+    def generate(self, pixel_values, num_beams):
+        if num_beams == 1 and isinstance(self.image_to_text.model, VisionEncoderDecoderModel):
+            return greedy_generate(self.image_to_text, pixel_values)
+        return self.image_to_text.generate(pixel_values, num_beams)
+
+    def iter_texts(self, img_paths, num_beams=1):
+        # only the key, ink density and predicted length of each crop are kept up front,
+        # pixel values are built per bucket so memory stays bounded by the batch size, not the number of images
+        keys, densities, predicted = [], [], []
+        for img_path in img_paths:
+            image = self.image_to_text.open_img(img_path)
+            keys.append(content_hash(image))
+            densities.append(self.predictor.ink_density(image))
+            predicted.append(self.predictor.predict(image, keys[-1]))
+
+        pad_token_id = self.image_to_text.processor.tokenizer.pad_token_id
+        for bucket in self.make_buckets(predicted):
+            images, pixel_values = self.image_to_text.load_imgs([img_paths[idx] for idx in bucket])
+            outputs = self.generate(pixel_values, num_beams)
+            lengths = sequence_lengths(outputs.sequences, pad_token_id)
+            decoded = self.image_to_text.batch_postprocessing(outputs, raise_errors=False)
+            for idx, image, length, (seq, content) in zip(bucket, images, lengths, decoded):
+                self.predictor.update(image, length, keys[idx], density=densities[idx])
+                yield idx, (content, image, seq)
+        self.predictor.save()
+
+    def get_texts(self, img_paths, num_beams=1):
+        results = [None] * len(img_paths)
+        for idx, result in self.iter_texts(img_paths, num_beams):
+            results[idx] = result
+        return results
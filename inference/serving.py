@@ -0,0 +1,104 @@
+import time
+import asyncio
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+@dataclass
+class ServedResult:
+    contents: list
+    seq: dict
+    queue_wait: float
+    compute_time: float
+    batch_size: int
+
+
+@dataclass
+class _Request:
+    img_path: object
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class BatchingServer:
+    def __init__(self, image_to_text, num_beams=4, max_batch_size=8, batch_window=0.02, max_queue_size=64):
+        self.image_to_text = image_to_text
+        self.num_beams = num_beams
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_queue_size = max_queue_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.worker = None
+
+    def start(self):
+        if self.worker is None:
+            self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, img_path):
+        self.start()
+        request = _Request(img_path, asyncio.get_running_loop().create_future(), time.perf_counter())
+        try:
+            self.queue.put_nowait(request)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"request queue is full ({self.max_queue_size} pending)")
+        return await request.future
+
+    async def collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect_batch()
+            started_at = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(
+                    self.executor,
+                    self.image_to_text.get_texts,
+                    [request.img_path for request in batch],
+                    len(batch),
+                    self.num_beams,
+                )
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+
+            compute_time = time.perf_counter() - started_at
+            for request, (contents, _, seq) in zip(batch, results):
+                if request.future.done():
+                    continue
+                if contents is None:
+                    request.future.set_exception(seq)
+                    continue
+                request.future.set_result(ServedResult(
+                    contents=contents,
+                    seq=seq,
+                    queue_wait=started_at - request.enqueued_at,
+                    compute_time=compute_time,
+                    batch_size=len(batch),
+                ))
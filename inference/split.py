@@ -0,0 +1,189 @@
+import io
+import os
+import glob
+import time
+import threading
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+from .pool import WorkerPool
+
+
+def _encoder_main(worker_id, model_path, num_threads, ort_options, task_queue, hidden_queue, result_queue):
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+
+    import torch
+    import numpy as np
+    from PIL import Image
+    from transformers import DonutProcessor, VisionEncoderDecoderModel
+    from inference.preprocess import TensorPreprocessor
+
+    processor = DonutProcessor.from_pretrained(model_path)
+    preprocessor = TensorPreprocessor.from_processor(processor)
+
+    if ('onnx' in model_path) or ('quantized' in model_path):
+        import onnxruntime as ort
+        from inference.ort_session import OrtSessionConfig, optimize_graphs
+        ort_config = OrtSessionConfig(**dict(ort_options, intra_op_num_threads=num_threads, inter_op_num_threads=1))
+        # the pool already wrote the graph cache in prepare, so this only resolves the cached path
+        ort_model_path = optimize_graphs(model_path, ort_config) if ort_config.optimized_model_dir else model_path
+        # quantize.py writes encoder_model_quantized.onnx, so match any suffix but insist on a single encoder
+        encoder_paths = glob.glob(os.path.join(ort_model_path, "encoder_model*.onnx"))
+        if len(encoder_paths) != 1:
+            raise FileNotFoundError(f"expected exactly one encoder_model*.onnx in {ort_model_path}, found {len(encoder_paths)}")
+        session = ort.InferenceSession(encoder_paths[0], ort_config.session_options(), providers=[ort_config.provider])
+
+        # the hidden states are copied into shared memory on the host anyway, so there is nothing to gain from IO binding here
+        def encode(pixel_values):
+            return session.run(["last_hidden_state"], {"pixel_values": pixel_values.numpy()})[0]
+    else:
+        torch.set_num_threads(num_threads)
+        encoder = VisionEncoderDecoderModel.from_pretrained(model_path).encoder.eval()
+
+        def encode(pixel_values):
+            with torch.no_grad():
+                return encoder(pixel_values=pixel_values).last_hidden_state.numpy()
+
+    result_queue.put(("ready", worker_id, None))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        request_id, image_bytes, num_beams = task
+        result_queue.put(("started", request_id, worker_id))
+        started_at = time.perf_counter()
+        try:
+            img = np.asarray(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
+            _, pixel_values = preprocessor([img])
+            hidden_states = encode(pixel_values)
+
+            shm = SharedMemory(create=True, size=hidden_states.nbytes)
+            np.ndarray(hidden_states.shape, dtype=hidden_states.dtype, buffer=shm.buf)[:] = hidden_states
+            # released before the handoff, so it cannot arrive after the decoder has already claimed the request
+            result_queue.put(("started", request_id, None))
+            hidden_queue.put((request_id, shm.name, hidden_states.shape, hidden_states.dtype.str, num_beams, time.perf_counter() - started_at))
+            # the decoder side owns the block from here on and unlinks it
+            shm.close()
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception as e:
+            result_queue.put(("error", request_id, repr(e)))
+    result_queue.put(("stopped", worker_id, None))
+
+
+def _decoder_main(worker_id, model_path, device, num_threads, ort_options, hidden_queue, result_queue):
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+
+    import torch
+    import numpy as np
+    from transformers.modeling_outputs import BaseModelOutput
+    from tutorial_utils import Image2Text
+    from inference.ort_session import OrtSessionConfig
+
+    torch.set_num_threads(num_threads)
+    ort_config = OrtSessionConfig(**dict(ort_options, intra_op_num_threads=num_threads, inter_op_num_threads=1))
+    image_to_text = Image2Text(model_path, device, ort_config=ort_config)
+    # encoder outputs always come from the encoder workers, so only the decoder is kept resident
+    image_to_text.drop_encoder()
+    result_queue.put(("ready", worker_id, None))
+
+    while True:
+        task = hidden_queue.get()
+        if task is None:
+            break
+        request_id, shm_name, shape, dtype, num_beams, encode_time = task
+        result_queue.put(("started", request_id, worker_id))
+        started_at = time.perf_counter()
+        shm = SharedMemory(name=shm_name)
+        try:
+            # zero-copy view of the encoder output written by the encoder process
+            hidden_states = torch.from_numpy(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+            encoder_outputs = BaseModelOutput(last_hidden_state=hidden_states.to(device))
+            outputs = image_to_text.generate(None, num_beams, encoder_outputs=encoder_outputs)
+            del hidden_states, encoder_outputs
+            seq, contents = image_to_text.postprocessing(outputs)
+            result_queue.put(("ok", request_id, {
+                "contents": contents,
+                "seq": seq,
+                "encode_time": encode_time,
+                "compute_time": encode_time + time.perf_counter() - started_at,
+                "worker": worker_id,
+            }))
+        except Exception as e:
+            result_queue.put(("error", request_id, repr(e)))
+        finally:
+            try:
+                shm.close()
+            except BufferError:
+                pass
+            shm.unlink()
+    result_queue.put(("stopped", worker_id, None))
+
+
+class SplitPipeline(WorkerPool):
+    """
+    Encoder and decoder run in separate process pools that scale independently.
+    Encoder workers write the hidden states of each image into a shared memory block
+    and decoder workers run the autoregressive loop directly on a view of it.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        device="cpu",
+        num_encoder_workers=1,
+        num_decoder_workers=3,
+        encoder_threads=None,
+        decoder_threads=None,
+        num_beams=4,
+        ort_options=None,
+    ):
+        super().__init__(
+            model_path,
+            device=device,
+            num_workers=num_encoder_workers + num_decoder_workers,
+            num_beams=num_beams,
+            ort_options=ort_options,
+        )
+        self.num_encoder_workers = num_encoder_workers
+        self.num_decoder_workers = num_decoder_workers
+        self.encoder_threads = encoder_threads or self.threads_per_worker
+        self.decoder_threads = decoder_threads or self.threads_per_worker
+        self.hidden_queue = self.context.Queue()
+
+    def start(self):
+        self.prepare()
+        for worker_id in range(self.num_encoder_workers):
+            process = self.context.Process(
+                target=_encoder_main,
+                args=(worker_id, self.model_path, self.encoder_threads, self.ort_options, self.task_queue, self.hidden_queue, self.result_queue),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+        for worker_id in range(self.num_encoder_workers, self.num_workers):
+            process = self.context.Process(
+                target=_decoder_main,
+                args=(worker_id, self.model_path, self.device, self.decoder_threads, self.ort_options, self.hidden_queue, self.result_queue),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def drain(self, timeout=60):
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for _ in range(self.num_encoder_workers):
+            self.task_queue.put(None)
+        for _ in range(self.num_decoder_workers):
+            self.hidden_queue.put(None)
+        for process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,60 @@
+import os
+import json
+import glob
+import shutil
+
+
+def has_safetensors(model_path):
+    return bool(glob.glob(os.path.join(model_path, "*.safetensors")))
+
+
+def needs_safetensors_copy(model_path):
+    # ONNX exports are loaded by ORT, only PyTorch checkpoints without safetensors weights are converted
+    return not (('onnx' in model_path) or ('quantized' in model_path)) and not has_safetensors(model_path)
+
+
+def _checkpoint_manifest(model_path):
+    manifest = {}
+    for weight_path in sorted(glob.glob(os.path.join(model_path, "*.bin"))):
+        stat = os.stat(weight_path)
+        manifest[os.path.basename(weight_path)] = [stat.st_size, stat.st_mtime_ns]
+    return manifest
+
+
+def convert_to_safetensors(model_path, artifact_dir):
+    # safetensors checkpoints are memory-mapped on load instead of unpickled into fresh buffers.
+    # the converted copy goes under artifact_dir so the served checkpoint, and everything keyed on it, stays untouched
+    if not needs_safetensors_copy(model_path):
+        return model_path
+    converted_path = os.path.join(artifact_dir, "safetensors", os.path.basename(os.path.normpath(model_path)))
+    manifest_path = os.path.join(converted_path, "safetensors_manifest.json")
+    manifest = _checkpoint_manifest(model_path)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            if json.load(file) == manifest:
+                return converted_path
+
+    from transformers import VisionEncoderDecoderModel
+    os.makedirs(converted_path, exist_ok=True)
+    for file_name in os.listdir(model_path):
+        source = os.path.join(model_path, file_name)
+        if os.path.isfile(source) and not file_name.endswith(".bin"):
+            shutil.copy2(source, os.path.join(converted_path, file_name))
+    model = VisionEncoderDecoderModel.from_pretrained(model_path)
+    model.save_pretrained(converted_path, safe_serialization=True)
+
+    with open(manifest_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    return converted_path
+
+
+def enable_compile_cache(artifact_dir):
+    # inductor reads these at compile time, so they have to be set before the first torch.compile call runs
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(artifact_dir, "inductor"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
@@ -0,0 +1,109 @@
+import re
+import math
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+class RepetitionLoopCriteria(StoppingCriteria):
+    # stops a row whose tail is the same block of tokens repeated, e.g. the same [newline] line over and over
+    def __init__(self, max_period=128, min_repeats=3, min_span=32):
+        self.max_period = max_period
+        self.min_repeats = min_repeats
+        self.min_span = min_span
+
+    def __call__(self, input_ids, scores, **kwargs):
+        looping = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for period in range(1, self.max_period + 1):
+            repeats = max(self.min_repeats, math.ceil(self.min_span / period))
+            if period * repeats > input_ids.shape[1]:
+                break
+            tail = input_ids[:, -period * repeats:].view(input_ids.shape[0], repeats, period)
+            looping |= (tail == tail[:, :1]).all(dim=2).all(dim=1)
+        return looping
+
+
+class ChoicesCompleteCriteria(StoppingCriteria):
+    # a problem ends with its choice block, so stop once ① to ⑤ have appeared in order and a tag closes after them.
+    # a [newline] does not end the block, problems can go on to ⑥ and beyond, and stems may mention single choices
+    def __init__(self, tokenizer, choices=('①', '②', '③', '④', '⑤')):
+        self.choice_ids = tokenizer.convert_tokens_to_ids(list(choices))
+        self.enabled = tokenizer.unk_token_id not in self.choice_ids
+        self.close_ids = [idx for token, idx in tokenizer.get_added_vocab().items() if re.fullmatch(r"</s_.+>", token)]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if not self.enabled or not self.close_ids:
+            return done
+        block_end = torch.isin(input_ids[:, -1], torch.tensor(self.close_ids, device=input_ids.device))
+        if not block_end.any():
+            return done
+        # walk back from the closing tag: last ⑤ before it, last ④ before that ⑤, and so on down to ①
+        positions = torch.arange(input_ids.shape[1], device=input_ids.device)
+        bound = torch.full((input_ids.shape[0],), input_ids.shape[1] - 1, device=input_ids.device)
+        for choice_id in reversed(self.choice_ids):
+            found = (input_ids == choice_id) & (positions < bound[:, None])
+            bound = torch.where(found, positions, -1).max(dim=1).values
+        return block_end & (bound >= 0)
+
+
+class BalancedTagsCriteria(StoppingCriteria):
+    # stops once every <s_k> opened after the prompt has been closed again
+    def __init__(self, tokenizer, prompt_length=1):
+        self.prompt_length = prompt_length
+        added_vocab = tokenizer.get_added_vocab()
+        self.open_ids = [idx for token, idx in added_vocab.items() if re.fullmatch(r"<s_.+>", token)]
+        self.close_ids = [idx for token, idx in added_vocab.items() if re.fullmatch(r"</s_.+>", token)]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids[:, self.prompt_length:]
+        if generated.shape[1] == 0 or not self.close_ids:
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        opened = torch.isin(generated, torch.tensor(self.open_ids, device=input_ids.device)).sum(dim=1)
+        closed = torch.isin(generated, torch.tensor(self.close_ids, device=input_ids.device)).sum(dim=1)
+        last_is_close = torch.isin(generated[:, -1], torch.tensor(self.close_ids, device=input_ids.device))
+        return last_is_close & (opened == closed)
+
+
+class TokenBudgetCriteria(StoppingCriteria):
+    def __init__(self, budgets):
+        self.budgets = budgets
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # beam search hands over batch_size * num_beams rows
+        budgets = self.budgets.to(input_ids.device).repeat_interleave(input_ids.shape[0] // len(self.budgets))
+        return input_ids.shape[1] >= budgets
+
+
+def token_budgets(pixel_values, image_mean, image_std, predictor, factor=2.0, min_budget=256, max_length=2048):
+    # ink density of the normalized input, read the same way LengthPredictor reads the PIL crop
+    mean = torch.tensor(image_mean, device=pixel_values.device).view(1, 3, 1, 1)
+    std = torch.tensor(image_std, device=pixel_values.device).view(1, 3, 1, 1)
+    gray = (pixel_values * std + mean).mean(dim=1)
+    density = (gray < predictor.ink_threshold / 255).float().mean(dim=(1, 2)).cpu()
+    predicted = predictor.intercept + predictor.slope * density
+    return (predicted * factor).clamp(min=min_budget, max=max_length).long()
+
+
+def build_stopping_criteria(tokenizer, budgets=None, repetition=True, choices=True, balanced_tags=True):
+    criteria = StoppingCriteriaList()
+    if repetition:
+        criteria.append(RepetitionLoopCriteria())
+    if choices:
+        criteria.append(ChoicesCompleteCriteria(tokenizer))
+    if balanced_tags:
+        criteria.append(BalancedTagsCriteria(tokenizer))
+    if budgets is not None:
+        criteria.append(TokenBudgetCriteria(budgets))
+    return criteria
+
+
+def close_open_tags(seq):
+    # sequences cut by a stopping criterion may miss their closing tags, which token2json needs
+    stack = []
+    for closing, key in re.findall(r"<(/?)s_(.+?)>", seq):
+        if not closing:
+            stack.append(key)
+        elif key in stack:
+            while stack and stack.pop() != key:
+                pass
+    return seq + "".join(f"</s_{key}>" for key in reversed(stack))
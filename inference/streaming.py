@@ -0,0 +1,57 @@
+import re
+from queue import Queue
+from transformers.generation.streamers import BaseStreamer
+
+
+class TokenQueueStreamer(BaseStreamer):
+    def __init__(self, skip_prompt=True):
+        self.skip_prompt = skip_prompt
+        self.prompt_seen = False
+        self.queue = Queue()
+
+    def put(self, value):
+        if self.skip_prompt and not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        self.queue.put(value.flatten().tolist())
+
+    def end(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            token_ids = self.queue.get()
+            if token_ids is None:
+                return
+            yield token_ids
+
+
+class IncrementalDecoder:
+    # the streaming counterpart of Image2Text.postprocessing: <s_...> tags are dropped and [newline] starts a new line
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        added_vocab = tokenizer.get_added_vocab()
+        self.newline_id = added_vocab.get('[newline]')
+        self.skip_ids = {idx for token, idx in added_vocab.items() if re.fullmatch(r"</?s_.*?>", token)}
+        self.skip_ids.update(idx for idx in (tokenizer.eos_token_id, tokenizer.pad_token_id, tokenizer.bos_token_id) if idx is not None)
+        self.line_ids = []
+        self.contents = ['']
+
+    def feed(self, token_ids):
+        changed = False
+        for token_id in token_ids:
+            if token_id in self.skip_ids:
+                continue
+            if token_id == self.newline_id:
+                self.line_ids = []
+                self.contents.append('')
+                changed = True
+                continue
+
+            self.line_ids.append(token_id)
+            text = self.tokenizer.decode(self.line_ids)
+            # wait for the rest of a multi-byte character before showing it
+            if not text.endswith('�'):
+                self.contents[-1] = text.lstrip() if len(self.contents) == 1 else text
+                changed = True
+        return changed
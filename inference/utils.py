@@ -0,0 +1,27 @@
+import hashlib
+import torch
+import numpy as np
+from PIL import Image
+
+
+def content_hash(data):
+    header = ''
+    if isinstance(data, Image.Image):
+        header = f'{data.mode}{data.size}'
+        data = data.tobytes()
+    elif isinstance(data, torch.Tensor):
+        data = data.detach().cpu().contiguous().numpy()
+
+    if isinstance(data, np.ndarray):
+        header = f'{data.dtype}{data.shape}'
+        data = np.ascontiguousarray(data).tobytes()
+    elif not isinstance(data, (bytes, bytearray)):
+        raise TypeError(f"unsupported type for content_hash: {type(data)}")
+
+    digest = hashlib.blake2b(header.encode(), digest_size=16)
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def sequence_lengths(sequences, pad_token_id):
+    return (sequences != pad_token_id).sum(dim=-1).tolist()
@@ -0,0 +1,55 @@
+import json
+import time
+import argparse
+import urllib.request
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from dataset.utils import list_all_files
+
+
+def send_request(url, image_path):
+    with open(image_path, "rb") as file:
+        data = file.read()
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/octet-stream"})
+    started_at = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            json.loads(response.read())
+            ok = response.status == 200
+    except Exception:
+        ok = False
+    return ok, time.perf_counter() - started_at
+
+
+def load_test(args):
+    image_paths = list_all_files(args.image_dir)
+    jobs = [image_paths[idx % len(image_paths)] for idx in range(args.num_requests)]
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda path: send_request(args.url, path), jobs))
+    elapsed = time.perf_counter() - started_at
+
+    latencies = np.array([latency for ok, latency in results if ok])
+    report = {
+        "requests": len(results),
+        "errors": sum(not ok for ok, _ in results),
+        "concurrency": args.concurrency,
+        "throughput": len(latencies) / elapsed,
+    }
+    if len(latencies):
+        report.update({f"p{q}": float(np.percentile(latencies, q)) for q in (50, 95, 99)})
+    print(json.dumps(report, indent=2))
+
+# python load_test.py --url http://localhost:8000/predict --image_dir sample --num_requests 200 --concurrency 16
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://localhost:8000/predict")
+    parser.add_argument("--image_dir", type=str, default="sample")
+    parser.add_argument("--num_requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args, _ = parser.parse_known_args()
+
+    load_test(args)
@@ -0,0 +1,66 @@
+import json
+import time
+import argparse
+from sconf import Config
+
+from train import load_pretrained_model, build_datasets, build_dataloader
+
+
+def measure(config, dataset, num_workers, num_batches, warmup):
+    loader = build_dataloader(config, dataset, config.train_batch_size, shuffle=True, num_workers=num_workers)
+    batches = iter(loader)
+    # the first batches include worker startup, which persistent_workers only pays once per run
+    started_at = time.perf_counter()
+    for _ in range(warmup):
+        next(batches)
+    startup = time.perf_counter() - started_at
+
+    samples = 0
+    started_at = time.perf_counter()
+    for _ in range(num_batches):
+        pixel_values, _, _ = next(batches)
+        samples += len(pixel_values)
+    elapsed = time.perf_counter() - started_at
+    return {
+        "num_workers": num_workers,
+        "samples_per_sec": samples / elapsed,
+        "startup_time": startup,
+    }
+
+# python loader_benchmark.py --config config/problems.yaml \
+#                            --pretrained_model_name_or_path "facebook/nougat-base" \
+#                            --processor_name_or_path "naver-clova-ix/donut-base" \
+#                            --dataset_path "path/to/dataset" \
+#                            --num_workers 0 2 4 8
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--pretrained_model_name_or_path", type=str, required=True)
+    parser.add_argument("--processor_name_or_path", type=str, required=True)
+    parser.add_argument("--dataset_path", type=str, required=True)
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 2, 4, 8])
+    parser.add_argument("--num_batches", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None)
+    args, left_argv = parser.parse_known_args()
+
+    config = Config(args.config)
+    config.argv_update(left_argv)
+    config.update({
+        "pretrained_model_name_or_path": args.pretrained_model_name_or_path,
+        "processor_name_or_path": args.processor_name_or_path,
+        "dataset_path": args.dataset_path,
+    })
+
+    tokenizer, model, processor = load_pretrained_model(config)
+    train_dataset, _ = build_datasets(config, tokenizer, model, processor)
+    results = []
+    for num_workers in args.num_workers:
+        result = measure(config, train_dataset, num_workers, args.num_batches, args.warmup)
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"results": results}, file, indent=2)
@@ -1,3 +1,7 @@
-from .lightning_module import DonutModelPLModule
+from .lightning_module import DonutModelPLModule, DraftDistillPLModule
 from .util import DonutDataset
-from .transforms import train_transform, test_transform
\ No newline at end of file
+from .token_cache import TokenCache, vocab_hash
+from .batching import DynamicPaddingCollator, LengthBucketBatchSampler, ShardedSampler
+from .transforms import train_transform, test_transform
+from .draft import build_draft_model, draft_parity_report
+from .metrics import EditDistanceMetric, levenshtein, normed_edit_distance
@@ -0,0 +1,132 @@
+import math
+import random
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def distributed_rank():
+    # resolved on iteration, the loaders are built before the trainer starts the process group
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def shard(items, rank, world_size):
+    # pad by wrapping around so every rank gets the same number of steps, as DistributedSampler does
+    if world_size > 1 and items:
+        items = items + items[:(-len(items)) % world_size]
+    return items[rank::world_size]
+
+
+class DynamicPaddingCollator:
+    """
+    Stacks (pixel_values, labels, target_sequence) samples and pads labels only up to the longest target in the batch,
+    so the decoder and the cross-entropy do not run over max_length worth of ignored positions.
+
+    Args:
+        ignore_id: label value of padded positions, has to match DonutDataset.ignore_id
+        pad_to_multiple_of: round the padded length up, keeps the number of distinct shapes (and kernel variants) small
+        max_length: upper bound for the rounded length, DonutDataset.max_length
+    """
+
+    def __init__(self, ignore_id=-100, pad_to_multiple_of=8, max_length=None):
+        self.ignore_id = ignore_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.max_length = max_length
+
+    def target_length(self, labels):
+        positions = (labels != self.ignore_id).nonzero()
+        return int(positions[-1]) + 1 if len(positions) else 1
+
+    def __call__(self, batch):
+        pixel_values = torch.stack([sample[0] for sample in batch])
+        lengths = [self.target_length(sample[1]) for sample in batch]
+        width = max(lengths)
+        if self.pad_to_multiple_of:
+            width = math.ceil(width / self.pad_to_multiple_of) * self.pad_to_multiple_of
+        if self.max_length:
+            width = min(width, self.max_length)
+
+        labels = torch.full((len(batch), width), self.ignore_id, dtype=batch[0][1].dtype)
+        for row, (sample, length) in enumerate(zip(batch, lengths)):
+            labels[row, :length] = sample[1][:length]
+        return pixel_values, labels, [sample[2] for sample in batch]
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Yields batches of indices whose target lengths are close, so dynamic padding has little left to pad.
+    Indices are shuffled, cut into pools of batch_size * bucket_multiplier, sorted by length inside each pool,
+    split into batches and the batches shuffled again, so the order still changes every epoch.
+    Under torch.distributed every rank takes its own slice of the same batch list.
+
+    Args:
+        lengths: target token length per sample, e.g. DonutDataset.token_lengths()
+        bucket_multiplier: how many batches one sorting pool spans, larger pools pad less but mix less
+    """
+
+    def __init__(self, lengths, batch_size, bucket_multiplier=50, shuffle=True, drop_last=False, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_multiplier = bucket_multiplier
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        indices = list(range(len(self.lengths)))
+        rng = random.Random(self.seed + self.epoch)
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        pool_size = self.batch_size * self.bucket_multiplier
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start:start + pool_size], key=lambda idx: self.lengths[idx])
+            batches.extend(pool[idx:idx + self.batch_size] for idx in range(0, len(pool), self.batch_size))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(shard(self.batches(), *distributed_rank()))
+
+    def __len__(self):
+        # pools are whole multiples of batch_size, so only the very last batch can come out short
+        if self.drop_last:
+            num_batches = len(self.lengths) // self.batch_size
+        else:
+            num_batches = math.ceil(len(self.lengths) / self.batch_size)
+        return math.ceil(num_batches / distributed_rank()[1])
+
+
+class ShardedSampler(Sampler):
+    """
+    DistributedSampler that looks up rank and world size when iterated instead of when constructed,
+    so it can be created before the trainer initializes the process group.
+    """
+
+    def __init__(self, num_samples, shuffle=True, seed=0):
+        self.num_samples = num_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = list(range(self.num_samples))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(indices)
+        return iter(shard(indices, *distributed_rank()))
+
+    def __len__(self):
+        return math.ceil(self.num_samples / distributed_rank()[1])
@@ -0,0 +1,71 @@
+import re
+import copy
+import time
+import torch
+import numpy as np
+
+from .metrics import normed_edit_distance
+
+
+def build_draft_model(model, num_layers):
+    # keep evenly spaced layers of the full decoder (always including the last one) as the draft initialization
+    draft = copy.deepcopy(model)
+    decoder = draft.decoder.model.decoder
+    keep = np.linspace(0, len(decoder.layers) - 1, num_layers).round().astype(int)
+    decoder.layers = torch.nn.ModuleList([decoder.layers[idx] for idx in sorted(set(keep))])
+
+    draft.config.decoder.decoder_layers = len(decoder.layers)
+    draft.decoder.config.decoder_layers = len(decoder.layers)
+    for param in draft.encoder.parameters():
+        param.requires_grad = False
+    return draft
+
+
+def clean_sequence(seq, tokenizer):
+    seq = seq.replace(tokenizer.eos_token, "").replace(tokenizer.pad_token, "")
+    return re.sub(r"<.*?>", "", seq, count=1).strip()
+
+
+@torch.no_grad()
+def draft_parity_report(model, draft, dataloader, tokenizer, max_length, num_assistant_tokens=5):
+    model.eval()
+    draft.eval()
+    draft.encoder = model.encoder
+    draft.generation_config.num_assistant_tokens = num_assistant_tokens
+
+    exact_matches, scores, greedy_times, assisted_times = [], [], [], []
+    for pixel_values, _, _ in dataloader:
+        pixel_values = pixel_values.to(model.device)
+        for row in pixel_values.split(1):
+            encoder_outputs = model.get_encoder()(pixel_values=row)
+            kwargs = dict(
+                encoder_outputs=encoder_outputs,
+                decoder_input_ids=torch.full((1, 1), model.config.decoder_start_token_id, device=model.device),
+                max_length=max_length,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                use_cache=True,
+                num_beams=1,
+                bad_words_ids=[[tokenizer.unk_token_id]],
+            )
+            started_at = time.perf_counter()
+            greedy = model.generate(**kwargs)
+            greedy_times.append(time.perf_counter() - started_at)
+
+            started_at = time.perf_counter()
+            assisted = model.generate(**kwargs, assistant_model=draft, assistant_encoder_outputs=encoder_outputs)
+            assisted_times.append(time.perf_counter() - started_at)
+
+            greedy = clean_sequence(tokenizer.batch_decode(greedy)[0], tokenizer)
+            assisted = clean_sequence(tokenizer.batch_decode(assisted)[0], tokenizer)
+            exact_matches.append(greedy == assisted)
+            scores.append(normed_edit_distance(greedy, assisted))
+
+    return {
+        "samples": len(scores),
+        "exact_match": float(np.mean(exact_matches)),
+        "normed_edit_distance": float(np.mean(scores)),
+        "greedy_latency": float(np.mean(greedy_times)),
+        "assisted_latency": float(np.mean(assisted_times)),
+        "speedup": float(np.sum(greedy_times) / np.sum(assisted_times)),
+    }
@@ -1,8 +1,11 @@
 import re
 import torch
-import numpy as np
+import torch.distributed as dist
 import pytorch_lightning as pl
-from nltk import edit_distance
+import torch.nn.functional as F
+
+from .metrics import EditDistanceMetric, normed_edit_distance
+from .token_cache import vocab_hash
 
 
 class DonutModelPLModule(pl.LightningModule):
@@ -12,6 +15,15 @@ class DonutModelPLModule(pl.LightningModule):
         self.model = model
         self.tokenizer = tokenizer
         self.train_dataloader_, self.val_dataloader_ = data_loaders
+        self.val_metric = EditDistanceMetric()
+
+    def setup(self, stage):
+        # tokens are registered independently on every rank, a diverging vocabulary would silently mix up embeddings
+        if dist.is_available() and dist.is_initialized():
+            hashes = [None] * dist.get_world_size()
+            dist.all_gather_object(hashes, vocab_hash(self.tokenizer))
+            if len(set(hashes)) > 1:
+                raise RuntimeError(f"tokenizer vocabularies differ across ranks: {hashes}")
 
     def training_step(self, batch, batch_idx):
         pixel_values, labels, _ = batch
@@ -32,14 +44,16 @@ class DonutModelPLModule(pl.LightningModule):
 
         outputs = self.model.generate(pixel_values,
                                    decoder_input_ids=decoder_input_ids,
-                                   max_length=max_length,
+                                   max_length=self.config.max_length,
                                    early_stopping=True,
                                    pad_token_id=self.tokenizer.pad_token_id,
                                    eos_token_id=self.tokenizer.eos_token_id,
                                    use_cache=True,
                                    num_beams=1,
                                    bad_words_ids=[[self.tokenizer.unk_token_id]],
-                                   return_dict_in_generate=True,)
+                                   return_dict_in_generate=True,
+                                   # sharded parameters are gathered per forward, so every rank has to keep stepping until all are done
+                                   synced_gpus=self.config.get("strategy") == "fsdp",)
 
         predictions = []
         for seq in self.tokenizer.batch_decode(outputs.sequences):
@@ -47,24 +61,23 @@ class DonutModelPLModule(pl.LightningModule):
             seq = re.sub(r"<.*?>", "", seq, count=1).strip()  # remove first task start token
             predictions.append(seq)
 
-        scores = []
-        for pixel_value, pred, answer in zip(pixel_values, predictions, answers):
-            pred = re.sub(r"(?:(?<=>) | (?=</s_))", "", pred)
-            # NOT NEEDED ANYMORE
-            # answer = re.sub(r"<.*?>", "", answer, count=1)
-            answer = answer.replace(self.tokenizer.eos_token, "")
-            scores.append(edit_distance(pred, answer) / max(len(pred), len(answer)))
+        predictions = [re.sub(r"(?:(?<=>) | (?=</s_))", "", pred) for pred in predictions]
+        answers = [answer.replace(self.tokenizer.eos_token, "") for answer in answers]
+        # scored on a background thread while the next batch generates
+        self.val_metric.update(predictions, answers)
 
-            if self.config.get("verbose", False) and len(scores) == 1:
-                print(f"Prediction: {pred}")
-                print(f"    Answer: {answer}")
-                print(f" Normed ED: {scores[0]}")
-                print()
+        if self.config.get("verbose", False):
+            print(f"Prediction: {predictions[0]}")
+            print(f"    Answer: {answers[0]}")
+            print(f" Normed ED: {normed_edit_distance(predictions[0], answers[0])}")
+            print()
 
-        self.log("val_loss", loss, on_step=True, on_epoch=True)
-        self.log("val_edit_distance", np.mean(scores), on_epoch=True)
+        self.log("val_loss", loss, on_step=True, on_epoch=True, sync_dist=True)
+        return loss
 
-        return scores
+    def on_validation_epoch_end(self):
+        self.log("val_edit_distance", self.val_metric.compute(), sync_dist=True)
+        self.val_metric.reset()
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.config.get("lr"))
@@ -75,3 +88,48 @@ class DonutModelPLModule(pl.LightningModule):
 
     def val_dataloader(self):
         return self.val_dataloader_
+
+
+class DraftDistillPLModule(DonutModelPLModule):
+    def __init__(self, config, model, teacher, tokenizer, data_loaders):
+        super().__init__(config, model, tokenizer, data_loaders)
+        self.teacher = teacher.eval()
+        for param in self.teacher.parameters():
+            param.requires_grad = False
+
+    def distill_loss(self, pixel_values, labels):
+        with torch.no_grad():
+            encoder_outputs = self.teacher.get_encoder()(pixel_values=pixel_values)
+            teacher_logits = self.teacher(encoder_outputs=encoder_outputs, labels=labels).logits
+
+        outputs = self.model(encoder_outputs=encoder_outputs, labels=labels)
+        mask = labels != -100
+        temperature = self.config.get("distill_temperature", 2.0)
+        kd_loss = F.kl_div(
+            F.log_softmax(outputs.logits[mask] / temperature, dim=-1),
+            F.softmax(teacher_logits[mask] / temperature, dim=-1),
+            reduction="batchmean",
+        ) * temperature ** 2
+        alpha = self.config.get("distill_alpha", 0.5)
+        agreement = (outputs.logits[mask].argmax(-1) == teacher_logits[mask].argmax(-1)).float().mean()
+        return alpha * kd_loss + (1 - alpha) * outputs.loss, agreement
+
+    def training_step(self, batch, batch_idx):
+        pixel_values, labels, _ = batch
+        loss, _ = self.distill_loss(pixel_values, labels)
+        self.log("train_loss", loss, on_step=True)
+        return loss
+
+    def validation_step(self, batch, batch_idx, dataset_idx=0):
+        pixel_values, labels, _ = batch
+        loss, agreement = self.distill_loss(pixel_values, labels)
+        self.log("val_loss", loss, on_epoch=True, sync_dist=True)
+        self.log("val_token_agreement", agreement, on_epoch=True, sync_dist=True)
+        return loss
+
+    def on_validation_epoch_end(self):
+        pass
+
+    def configure_optimizers(self):
+        params = [param for param in self.model.parameters() if param.requires_grad]
+        return torch.optim.Adam(params, lr=self.config.get("lr"))
@@ -0,0 +1,79 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def levenshtein(a, b):
+    # bit-parallel Levenshtein (Myers/Hyyrö): one column of the DP table per character of the longer string,
+    # packed into a python int, so ~800 character sequences cost a few hundred big-int operations instead of 640k cells
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return len(a)
+
+    peq = {}
+    for idx, char in enumerate(b):
+        peq[char] = peq.get(char, 0) | (1 << idx)
+    mask = (1 << len(b)) - 1
+    high = 1 << (len(b) - 1)
+    pv, mv, distance = mask, 0, len(b)
+    for char in a:
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & mask
+        mh = pv & xh
+        if ph & high:
+            distance += 1
+        elif mh & high:
+            distance -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+    return distance
+
+
+def normed_edit_distance(pred, answer):
+    return levenshtein(pred, answer) / max(len(pred), len(answer), 1)
+
+
+def batch_normed_edit_distance(preds, answers):
+    return [normed_edit_distance(pred, answer) for pred, answer in zip(preds, answers)]
+
+
+class EditDistanceMetric:
+    """
+    Accumulates normalized edit distances, scoring each batch on a background thread
+    so decoding of the next validation batch does not wait for it.
+
+    Args:
+        background: score on a worker thread, otherwise inline
+    """
+
+    def __init__(self, background=True):
+        self.background = background
+        self.executor = None
+        self.futures = []
+        self.scores = []
+
+    def update(self, preds, answers):
+        preds, answers = list(preds), list(answers)
+        if not self.background:
+            self.scores.extend(batch_normed_edit_distance(preds, answers))
+            return
+        if self.executor is None:
+            # created lazily so the module holding the metric stays picklable until validation starts
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="edit-distance")
+        self.futures.append(self.executor.submit(batch_normed_edit_distance, preds, answers))
+
+    def compute(self):
+        for future in self.futures:
+            self.scores.extend(future.result())
+        self.futures = []
+        return float(np.mean(self.scores)) if self.scores else float("nan")
+
+    def reset(self):
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+        self.scores = []
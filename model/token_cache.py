@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def vocab_hash(tokenizer):
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda item: item[1])
+    return hashlib.blake2b(json.dumps(vocab, ensure_ascii=False).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def cache_path(cache_dir, split, tokenizer, dataset=None):
+    # keyed by the vocabulary the dataset starts from, the tokens it adds on top are replayed from meta.json
+    key = f"{split}-{vocab_hash(tokenizer)}"
+    fingerprint = getattr(dataset, "_fingerprint", None)
+    if fingerprint:
+        key += f"-{fingerprint[:16]}"
+    return os.path.join(cache_dir, key)
+
+
+def added_token_runs(tokenizer, base_vocab_size):
+    special = set(tokenizer.all_special_tokens)
+    runs = []
+    for token, _ in sorted(tokenizer.get_added_vocab().items(), key=lambda item: item[1]):
+        if tokenizer.convert_tokens_to_ids(token) < base_vocab_size:
+            continue
+        if runs and runs[-1][0] == (token in special):
+            runs[-1][1].append(token)
+        else:
+            runs.append((token in special, [token]))
+    return runs
+
+
+def write_token_cache(path, tokenizer, base_vocab_size, gt_token_sequences, pixel_values=None):
+    """
+    Write tokenized targets (and optionally preprocessed pixel values) of a DonutDataset as flat .npy columns.
+
+    Args:
+        path: directory to write, usually cache_path(cache_dir, split, tokenizer) taken before the dataset added its tokens
+        base_vocab_size: vocabulary size before the dataset added its tokens, everything above is replayed on load
+        gt_token_sequences: per sample list of target sequences, as built by DonutDataset.json2token
+        pixel_values: optional iterable of un-augmented (3, H, W) tensors, one per sample, stored as float32
+                      so validation on cached pixels scores the same as on freshly preprocessed images
+    """
+    os.makedirs(path, exist_ok=True)
+    sequences = [sequence.replace('\n', '[newline]') for sequences in gt_token_sequences for sequence in sequences]
+    token_ids = [tokenizer(sequence, add_special_tokens=False)["input_ids"] for sequence in sequences]
+    texts = [sequence.encode("utf-8") for sequence in sequences]
+
+    np.save(os.path.join(path, "sample_offsets.npy"), np.cumsum([0] + [len(sequences) for sequences in gt_token_sequences]))
+    np.save(os.path.join(path, "token_offsets.npy"), np.cumsum([0] + [len(ids) for ids in token_ids]))
+    np.save(os.path.join(path, "token_ids.npy"), np.fromiter((i for ids in token_ids for i in ids), dtype=np.int32))
+    np.save(os.path.join(path, "text_offsets.npy"), np.cumsum([0] + [len(text) for text in texts]))
+    np.save(os.path.join(path, "texts.npy"), np.frombuffer(b"".join(texts), dtype=np.uint8))
+
+    if pixel_values is not None:
+        pixels = None
+        for idx, values in enumerate(pixel_values):
+            if pixels is None:
+                pixels = np.lib.format.open_memmap(
+                    os.path.join(path, "pixel_values.npy"), mode="w+", dtype=np.float32,
+                    shape=(len(gt_token_sequences),) + tuple(values.shape),
+                )
+            pixels[idx] = values.numpy()
+        pixels.flush()
+
+    meta = {
+        "added_tokens": added_token_runs(tokenizer, base_vocab_size),
+        "vocab_hash": vocab_hash(tokenizer),
+        "num_samples": len(gt_token_sequences),
+    }
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as file:
+        json.dump(meta, file, ensure_ascii=False, indent=2)
+
+
+class TokenCache:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.sample_offsets = self.load("sample_offsets")
+        self.token_offsets = self.load("token_offsets")
+        self.token_ids = self.load("token_ids")
+        self.text_offsets = self.load("text_offsets")
+        self.texts = self.load("texts")
+        self.pixel_values = self.load("pixel_values") if os.path.exists(os.path.join(path, "pixel_values.npy")) else None
+
+    def load(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.meta["num_samples"]
+
+    def replay_tokens(self, tokenizer):
+        added = []
+        for special, tokens in self.meta["added_tokens"]:
+            if special:
+                tokenizer.add_special_tokens({'additional_special_tokens': tokens})
+            else:
+                tokenizer.add_tokens(tokens)
+            added.extend(tokens)
+        if vocab_hash(tokenizer) != self.meta["vocab_hash"]:
+            raise ValueError(f"token cache {self.path} does not match the tokenizer, rebuild it with `train.py --mode build_cache`")
+        return added
+
+    def sequence_ids(self, sample_idx):
+        return range(self.sample_offsets[sample_idx], self.sample_offsets[sample_idx + 1])
+
+    def token_lengths(self):
+        return np.diff(self.token_offsets)
+
+    def tokens(self, sequence_idx):
+        return self.token_ids[self.token_offsets[sequence_idx]:self.token_offsets[sequence_idx + 1]]
+
+    def text(self, sequence_idx):
+        return bytes(self.texts[self.text_offsets[sequence_idx]:self.text_offsets[sequence_idx + 1]]).decode("utf-8")
@@ -1,10 +1,15 @@
+import os
 import re
 import json
 import torch
 import random
+import numpy as np
 from tqdm import tqdm
 from typing import Any, List, Tuple
 from torch.utils.data import Dataset
+from pytorch_lightning.utilities import rank_zero_only
+
+from .token_cache import TokenCache, cache_path, write_token_cache
 
 
 class DonutDataset(Dataset):
@@ -20,6 +25,8 @@ class DonutDataset(Dataset):
         task_start_token: the special token to be fed to the decoder to conduct the target task
         prompt_end_token: the special token at the end of the sequences
         sort_json_key: whether or not to sort the JSON keys
+        cache_dir: directory of pre-tokenized caches (see write_cache), used instead of json2token/tokenization when present
+        pad_to_max_length: pad labels to max_length here, turn off when batches are padded by DynamicPaddingCollator
     """
 
     def __init__(
@@ -35,7 +42,9 @@ class DonutDataset(Dataset):
         prompt_end_token: str = None,
         sort_json_key: bool = True,
         transform=None,
-        added_tokens=[]
+        added_tokens=[],
+        cache_dir=None,
+        pad_to_max_length=True
     ):
         super().__init__()
 
@@ -47,15 +56,24 @@ class DonutDataset(Dataset):
         self.sort_json_key = sort_json_key
         self.transform = transform
         self.added_tokens = added_tokens
+        self.pad_to_max_length = pad_to_max_length
 
         self.dataset = dataset
         self.tokenizer = tokenizer
         self.processor = processor
         self.dataset_length = len(self.dataset)
 
+        self.base_vocab_size = len(self.tokenizer)
+        self.cache_path = cache_path(cache_dir, split, tokenizer, dataset) if cache_dir else None
+        self.cache = TokenCache(self.cache_path) if self.cache_path and os.path.exists(self.cache_path) else None
         self.gt_token_sequences = []
-        
-        for sample in tqdm(self.dataset):
+
+        if self.cache is not None:
+            assert len(self.cache) == self.dataset_length
+            self.added_tokens.extend(self.cache.replay_tokens(tokenizer))
+
+        # every rank registers the same tokens in the same order, DonutModelPLModule.setup checks the vocabularies agree
+        for sample in tqdm(self.dataset if self.cache is None else [], disable=rank_zero_only.rank != 0):
             ground_truth = json.loads(sample["ground_truth"])
             if "gt_parses" in ground_truth: 
                 assert isinstance(ground_truth["gt_parses"], list)
@@ -75,7 +93,7 @@ class DonutDataset(Dataset):
                 ]
             )
 
-        if self.split == 'train':
+        if self.split == 'train' and self.cache is None:
             circle_numbers = ['①', '②', '③', '④', '⑤', '⑥', '⑦', '⑧', '⑨', '⑩', '⑪', '⑫', '⑬', '⑭', '⑮']
             tokenizer.add_special_tokens({'additional_special_tokens': circle_numbers})
             self.add_tokens(['[newline]', '[image]'])
@@ -129,28 +147,56 @@ class DonutDataset(Dataset):
             input_ids : tokenized gt_data
             labels : masked labels (model doesn't need to predict prompt and pad token)
         """
-        sample = self.dataset[idx]
-        img = sample["image"]
-
         # inputs
-        if self.transform:
-            img = self.transform(img)
+        if self.cache is not None and self.cache.pixel_values is not None and not self.transform and self.split != "train":
+            pixel_values = torch.from_numpy(self.cache.pixel_values[idx].astype(np.float32))
+        else:
+            img = self.dataset[idx]["image"]
+            if self.transform:
+                img = self.transform(img)
 
-        pixel_values = self.processor(img, random_padding=self.split == "train", return_tensors="pt").pixel_values
-        pixel_values = pixel_values.squeeze()
+            pixel_values = self.processor(img, random_padding=self.split == "train", return_tensors="pt").pixel_values
+            pixel_values = pixel_values.squeeze()
 
         # targets
-        target_sequence = random.choice(self.gt_token_sequences[idx])  
-        target_sequence = target_sequence.replace('\n', '[newline]')
-        input_ids = self.tokenizer(
-            target_sequence,
-            add_special_tokens=False,
-            max_length=self.max_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt",
-        )["input_ids"].squeeze(0)
+        if self.cache is not None:
+            sequence_idx = random.choice(self.cache.sequence_ids(idx))
+            target_sequence = self.cache.text(sequence_idx)
+            token_ids = self.cache.tokens(sequence_idx)[:self.max_length]
+            input_ids = torch.full((self.max_length if self.pad_to_max_length else len(token_ids),), self.tokenizer.pad_token_id, dtype=torch.long)
+            input_ids[:len(token_ids)] = torch.from_numpy(token_ids.astype(np.int64))
+        else:
+            target_sequence = random.choice(self.gt_token_sequences[idx])  
+            target_sequence = target_sequence.replace('\n', '[newline]')
+            input_ids = self.tokenizer(
+                target_sequence,
+                add_special_tokens=False,
+                max_length=self.max_length,
+                padding="max_length" if self.pad_to_max_length else False,
+                truncation=True,
+                return_tensors="pt",
+            )["input_ids"].squeeze(0)
 
         labels = input_ids.clone()
         labels[labels == self.tokenizer.pad_token_id] = self.ignore_id 
-        return pixel_values, labels, target_sequence
\ No newline at end of file
+        return pixel_values, labels, target_sequence
+
+    def token_lengths(self):
+        # longest target per sample, capped like __getitem__ caps it
+        if self.cache is not None:
+            lengths = self.cache.token_lengths()
+            return [min(int(max(lengths[idx] for idx in self.cache.sequence_ids(sample_idx))), self.max_length) for sample_idx in range(self.dataset_length)]
+        return [
+            min(max(len(ids) for ids in self.tokenizer([sequence.replace('\n', '[newline]') for sequence in sequences], add_special_tokens=False)["input_ids"]), self.max_length)
+            for sequences in tqdm(self.gt_token_sequences)
+        ]
+
+    def write_cache(self, with_pixel_values=False):
+        assert self.cache_path is not None and self.cache is None
+        pixel_values = None
+        if with_pixel_values:
+            pixel_values = (
+                self.processor(sample["image"], random_padding=False, return_tensors="pt").pixel_values.squeeze()
+                for sample in tqdm(self.dataset)
+            )
+        write_token_cache(self.cache_path, self.tokenizer, self.base_vocab_size, self.gt_token_sequences, pixel_values)
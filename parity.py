@@ -0,0 +1,70 @@
+import json
+import time
+import argparse
+import numpy as np
+
+from dataset.utils import list_all_files
+from inference.modes import parse_mode
+from tutorial_utils import Image2Text
+from model.metrics import normed_edit_distance
+
+
+def run_mode(args, mode, image_paths):
+    image_to_text = Image2Text(args.pretrained_path, args.device, **parse_mode(mode))
+    warmup_started_at = time.perf_counter()
+    image_to_text.warmup(num_beams=(args.num_beams,))
+    warmup_time = time.perf_counter() - warmup_started_at
+
+    predictions, latencies = [], []
+    for image_path in image_paths:
+        started_at = time.perf_counter()
+        try:
+            contents, _, _ = image_to_text.get_text(image_path, num_beams=args.num_beams)
+        except Exception:
+            contents = []
+        latencies.append(time.perf_counter() - started_at)
+        predictions.append('\n'.join(contents))
+    return predictions, latencies, warmup_time
+
+
+def parity(args):
+    image_paths = sorted(list_all_files(args.image_dir))
+    reference, reference_latencies, _ = run_mode(args, "fp32", image_paths)
+
+    report = []
+    for mode in args.modes:
+        predictions, latencies, warmup_time = run_mode(args, mode, image_paths)
+        report.append({
+            "mode": mode,
+            "warmup_time": warmup_time,
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "speedup": float(np.median(reference_latencies) / np.median(latencies)),
+            "normed_edit_distance": float(np.mean([normed_edit_distance(p, r) for p, r in zip(predictions, reference)])),
+            "exact_match": float(np.mean([p == r for p, r in zip(predictions, reference)])),
+        })
+        print(json.dumps(report[-1]))
+
+    accepted = [row for row in report if row["normed_edit_distance"] <= args.tolerance]
+    best = min(accepted, key=lambda row: row["latency_p50"])["mode"] if accepted else "fp32"
+    return {"reference_latency_p50": float(np.percentile(reference_latencies, 50)), "modes": report, "recommended": best}
+
+# python parity.py --pretrained_path models/donut_nougat_aug --image_dir path/to/heldout \
+#                  --modes bf16 compile channels_last bf16+compile+channels_last --output parity.json
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pretrained_path", type=str, default="models/donut_nougat_aug")
+    parser.add_argument("--image_dir", type=str, default="sample")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--modes", type=str, nargs="+", default=["bf16", "compile", "channels_last", "bf16+compile+channels_last"])
+    parser.add_argument("--num_beams", type=int, default=4)
+    parser.add_argument("--tolerance", type=float, default=0.01)
+    parser.add_argument("--output", type=str, default=None)
+    args, _ = parser.parse_known_args()
+
+    result = parity(args)
+    print(f"recommended mode: {result['recommended']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(result, file, indent=2)
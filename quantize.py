@@ -1,32 +1,164 @@
 import os
-from optimum.onnxruntime import ORTQuantizer, ORTModelForVision2Seq
-from optimum.onnxruntime.configuration import AutoQuantizationConfig
+import json
+import time
+import argparse
+import numpy as np
+import onnx
+from datasets import load_dataset
+from optimum.exporters.onnx import main_export
+from optimum.onnxruntime import ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig, AutoCalibrationConfig
+from transformers import DonutProcessor, VisionEncoderDecoderConfig
 
+from tutorial_utils import Image2Text
+from model.metrics import normed_edit_distance
 
-def quantize(args):
-    onnx_model_path = f'{args.model_path}_onnx'
 
-    model_files = ["encoder_model.onnx", "decoder_model.onnx", "decoder_model_merged.onnx", "decoder_with_past_model.onnx"]
-    quantizers = []
-    for model_file in model_files:
-        quantizer = ORTQuantizer.from_pretrained(onnx_model_path, file_name=model_file)  
-        quantizers.append(quantizer)
-    qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=args.per_channel)
+model_files = ["encoder_model.onnx", "decoder_model.onnx", "decoder_model_merged.onnx", "decoder_with_past_model.onnx"]
+quantization_configs = {
+    "arm64": AutoQuantizationConfig.arm64,
+    "avx2": AutoQuantizationConfig.avx2,
+    "avx512": AutoQuantizationConfig.avx512,
+    "avx512_vnni": AutoQuantizationConfig.avx512_vnni,
+}
+
+
+def export_onnx(model_path, onnx_model_path):
+    main_export(model_path, output=onnx_model_path, task="image-to-text-with-past")
+    VisionEncoderDecoderConfig.from_pretrained(model_path).save_pretrained(onnx_model_path)
+    DonutProcessor.from_pretrained(model_path).save_pretrained(onnx_model_path)
+
+
+def load_splits(args):
+    dataset = load_dataset(args.dataset_path)
+    return dataset['train'].train_test_split(test_size=args.num_validation, seed=args.seed)
+
 
+def load_calibration_dataset(train_dataset, processor, num_samples, seed):
+    samples = train_dataset.shuffle(seed=seed).select(range(min(num_samples, len(train_dataset))))
+
+    def preprocess(sample):
+        pixel_values = processor(sample["image"].convert("RGB"), return_tensors="np").pixel_values[0]
+        return {"pixel_values": pixel_values}
+
+    return samples.map(preprocess, remove_columns=samples.column_names)
+
+
+def find_nodes(onnx_file_path, patterns):
+    if not patterns:
+        return []
+    graph = onnx.load(onnx_file_path, load_external_data=False).graph
+    return [node.name for node in graph.node if any(pattern in node.name for pattern in patterns)]
+
+
+def quantize(args, onnx_model_path, calibration_dataset=None):
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
 
-    for q in quantizers:
-        q.quantize(save_dir=args.save_path, quantization_config=qconfig)
+    for model_file in model_files:
+        if not os.path.exists(os.path.join(onnx_model_path, model_file)):
+            continue
+
+        quantizer = ORTQuantizer.from_pretrained(onnx_model_path, file_name=model_file)
+        # the decoder inputs (token ids, past key values) are not available for calibration, so only the encoder is static
+        is_static = args.static and model_file == "encoder_model.onnx"
+        qconfig = quantization_configs[args.arch](is_static=is_static, per_channel=args.per_channel)
+        qconfig.nodes_to_exclude = find_nodes(os.path.join(onnx_model_path, model_file), args.exclude_nodes)
+
+        ranges = None
+        if is_static:
+            calibration_config = AutoCalibrationConfig.minmax(calibration_dataset)
+            ranges = quantizer.fit(
+                dataset=calibration_dataset,
+                calibration_config=calibration_config,
+                operators_to_quantize=qconfig.operators_to_quantize,
+                batch_size=args.calibration_batch_size,
+            )
+
+        print(f"quantizing {model_file} ({'static' if is_static else 'dynamic'}, {args.arch}, excluding {len(qconfig.nodes_to_exclude)} nodes)")
+        quantizer.quantize(save_dir=args.save_path, quantization_config=qconfig, calibration_tensors_range=ranges)
+
+    VisionEncoderDecoderConfig.from_pretrained(onnx_model_path).save_pretrained(args.save_path)
+    DonutProcessor.from_pretrained(onnx_model_path).save_pretrained(args.save_path)
+
+
+def evaluate(model_path, val_dataset, num_beams):
+    image_to_text = Image2Text(model_path, "cpu")
+    predictions, latencies = [], []
+    for sample in val_dataset:
+        started_at = time.perf_counter()
+        try:
+            contents, _, _ = image_to_text.get_text(np.asarray(sample["image"].convert("RGB")), num_beams=num_beams)
+        except Exception:
+            contents = []
+        latencies.append(time.perf_counter() - started_at)
+        predictions.append('\n'.join(contents))
+    return predictions, latencies
+
 
+def accuracy_report(args, val_dataset):
+    answers = [json.loads(sample["ground_truth"])["gt_parse"]["content"] for sample in val_dataset]
+    fp32_predictions, fp32_latencies = evaluate(args.model_path, val_dataset, args.num_beams)
+    quantized_predictions, quantized_latencies = evaluate(args.save_path, val_dataset, args.num_beams)
+
+    report = {
+        "arch": args.arch,
+        "static": args.static,
+        "excluded_nodes": args.exclude_nodes,
+        "samples": len(answers),
+        "fp32": {
+            "latency_p50": float(np.percentile(fp32_latencies, 50)),
+            "latency_p95": float(np.percentile(fp32_latencies, 95)),
+            "normed_edit_distance": float(np.mean([normed_edit_distance(p, a) for p, a in zip(fp32_predictions, answers)])),
+        },
+        "quantized": {
+            "latency_p50": float(np.percentile(quantized_latencies, 50)),
+            "latency_p95": float(np.percentile(quantized_latencies, 95)),
+            "normed_edit_distance": float(np.mean([normed_edit_distance(p, a) for p, a in zip(quantized_predictions, answers)])),
+        },
+        "fp32_vs_quantized_edit_distance": float(np.mean([
+            normed_edit_distance(q, f) for q, f in zip(quantized_predictions, fp32_predictions)
+        ])),
+    }
+    report["speedup"] = report["fp32"]["latency_p50"] / report["quantized"]["latency_p50"]
+
+    with open(os.path.join(args.save_path, "quantization_report.json"), "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+    return report
+
+# python quantize.py --model_path models/donut_nougat_aug --dataset_path path/to/dataset \
+#                    --static --arch avx512_vnni --exclude_nodes lm_head --report
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_path", type=str, required=True)
-    parser.add_argument("--per_channel", type=bool, default='store_true', required=False)
+    parser.add_argument("--per_channel", action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument("--save_path", type=str, default='./models/donut_quantized', required=False)
+    parser.add_argument("--arch", type=str, default="avx2", choices=list(quantization_configs))
+    parser.add_argument("--static", action="store_true")
+    parser.add_argument("--exclude_nodes", type=str, nargs="*", default=[])
+    parser.add_argument("--dataset_path", type=str, default=None)
+    parser.add_argument("--num_calibration_samples", type=int, default=128)
+    parser.add_argument("--calibration_batch_size", type=int, default=8)
+    parser.add_argument("--num_validation", type=int, default=144)
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--report", action="store_true")
+    parser.add_argument("--num_beams", type=int, default=4)
     args, _ = parser.parse_known_args()
-    
-    os.system(f'optimum-cli export onnx --model {args.model_path} --task image-to-text-with-past {args.model_path}_onnx/')
 
-    quantize(args)
\ No newline at end of file
+    if (args.static or args.report) and args.dataset_path is None:
+        parser.error("--dataset_path is required for --static calibration and --report")
+
+    onnx_model_path = f'{args.model_path}_onnx'
+    export_onnx(args.model_path, onnx_model_path)
+
+    splits = load_splits(args) if args.dataset_path else None
+    calibration_dataset = None
+    if args.static:
+        processor = DonutProcessor.from_pretrained(args.model_path)
+        calibration_dataset = load_calibration_dataset(splits['train'], processor, args.num_calibration_samples, args.seed)
+
+    quantize(args, onnx_model_path, calibration_dataset)
+    if args.report:
+        accuracy_report(args, splits['test'])
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import base64
+import signal
+import argparse
+import yaml
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from inference import WorkerPool, SplitPipeline, enable_compile_cache, needs_safetensors_copy
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    pool = None
+    request_timeout = 300
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, status, text):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/metrics" and self.pool.profiler is not None:
+            self.send_text(200, self.pool.profiler.prometheus_text())
+        elif self.path == "/healthz":
+            self.send_json(200 if self.pool.healthy else 503, {
+                "healthy": self.pool.healthy,
+                "workers_alive": sum(process.is_alive() for process in self.pool.processes),
+            })
+        elif self.path == "/readyz":
+            self.send_json(200 if self.pool.ready else 503, {
+                "ready": self.pool.ready,
+                "draining": self.pool.draining,
+                "workers": len(self.pool.ready_workers),
+                "in_flight": self.pool.in_flight,
+            })
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def read_image(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            request = json.loads(body)
+            return base64.b64decode(request["image"]), request.get("num_beams")
+        return body, None
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": "not found"})
+            return
+        if not self.pool.ready:
+            self.send_json(503, {"error": "service is not ready"})
+            return
+
+        started_at = time.perf_counter()
+        try:
+            image_bytes, num_beams = self.read_image()
+            result = self.pool.submit(image_bytes, num_beams).result(timeout=self.request_timeout)
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {"error": repr(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": repr(e)})
+            return
+        result["latency"] = time.perf_counter() - started_at
+        self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def build_pool(args):
+    ort_options = {}
+    if args.ort_config:
+        with open(args.ort_config, "r", encoding="utf-8") as file:
+            ort_options = yaml.safe_load(file) or {}
+
+    startup_options = {}
+    if args.artifact_dir:
+        # spawned workers inherit the environment, so they all share one compile cache
+        enable_compile_cache(args.artifact_dir)
+        ort_options.setdefault("optimized_model_dir", os.path.join(args.artifact_dir, "ort"))
+    if args.fast_startup:
+        startup_options = {"fast_startup": True, "warmup_beams": [args.num_beams], "artifact_dir": args.artifact_dir}
+
+    if args.num_encoder_workers and args.num_decoder_workers:
+        pool = SplitPipeline(
+            args.pretrained_path,
+            device=args.device,
+            num_encoder_workers=args.num_encoder_workers,
+            num_decoder_workers=args.num_decoder_workers,
+            encoder_threads=args.encoder_threads,
+            decoder_threads=args.decoder_threads,
+            num_beams=args.num_beams,
+            ort_options=ort_options,
+        )
+    else:
+        pool = WorkerPool(
+            args.pretrained_path,
+            device=args.device,
+            num_workers=args.num_workers,
+            threads_per_worker=args.threads_per_worker,
+            num_beams=args.num_beams,
+            pin_cores=args.pin_cores,
+            profile=args.profile,
+            ort_options=ort_options,
+            startup_options=startup_options,
+        )
+    return pool
+
+
+def check(args):
+    # one request through the pool without the HTTP server, exits non-zero if it does not come back
+    pool = build_pool(args)
+    pool.start()
+    deadline = time.monotonic() + InferenceHandler.request_timeout
+    while not pool.ready:
+        if not pool.healthy or time.monotonic() > deadline:
+            pool.drain(timeout=0)
+            raise SystemExit("workers did not become ready")
+        time.sleep(0.5)
+    try:
+        with open(args.check, "rb") as file:
+            result = pool.submit(file.read()).result(timeout=InferenceHandler.request_timeout)
+    finally:
+        pool.drain(timeout=10)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+def serve(args):
+    pool = build_pool(args)
+    pool.start()
+
+    InferenceHandler.pool = pool
+    httpd = ThreadingHTTPServer((args.host, args.port), InferenceHandler)
+    httpd.daemon_threads = True
+
+    def shutdown(signum, frame):
+        def drain():
+            pool.drain(timeout=args.drain_timeout)
+            httpd.shutdown()
+        threading.Thread(target=drain, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    print(f"serving on http://{args.host}:{args.port} with {pool.num_workers} workers")
+    httpd.serve_forever()
+    httpd.server_close()
+
+# python server.py --pretrained_path models/donut_quantized --num_workers 4 --threads_per_worker 4 --pin_cores
+# python server.py --pretrained_path models/donut_quantized --num_encoder_workers 1 --num_decoder_workers 6
+# python server.py --pretrained_path models/donut_nougat_aug --fast_startup --artifact_dir artifacts
+# python server.py --pretrained_path models/donut_quantized --num_encoder_workers 1 --num_decoder_workers 1 --check sample/sample1.png
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pretrained_path", type=str, default="models/donut_nougat_aug")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--threads_per_worker", type=int, default=None)
+    parser.add_argument("--num_beams", type=int, default=4)
+    parser.add_argument("--pin_cores", action="store_true")
+    parser.add_argument("--drain_timeout", type=float, default=60)
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--ort_config", type=str, default=None)
+    parser.add_argument("--num_encoder_workers", type=int, default=0)
+    parser.add_argument("--num_decoder_workers", type=int, default=0)
+    parser.add_argument("--encoder_threads", type=int, default=None)
+    parser.add_argument("--decoder_threads", type=int, default=None)
+    parser.add_argument("--fast_startup", action="store_true")
+    parser.add_argument("--artifact_dir", type=str, default=None)
+    parser.add_argument("--check", type=str, default=None)
+    args, _ = parser.parse_known_args()
+    if args.fast_startup and not args.artifact_dir and needs_safetensors_copy(args.pretrained_path):
+        parser.error("--fast_startup needs --artifact_dir to store the safetensors copy of a .bin checkpoint")
+    if args.num_encoder_workers and args.num_decoder_workers and (args.profile or args.pin_cores or args.fast_startup):
+        parser.error("--profile, --pin_cores and --fast_startup are not supported with --num_encoder_workers/--num_decoder_workers")
+
+    if args.check:
+        check(args)
+    else:
+        serve(args)
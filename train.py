@@ -1,4 +1,5 @@
 import os
+import json
 import torch
 import argparse
 import datetime
@@ -10,12 +11,11 @@ from pytorch_lightning.loggers import WandbLogger
 
 import pytorch_lightning as pl
 from pytorch_lightning.callbacks import Callback, EarlyStopping, LearningRateMonitor
+from pytorch_lightning.strategies import DDPStrategy, FSDPStrategy
 from transformers import DonutProcessor, AutoTokenizer, VisionEncoderDecoderModel
-from model import train_transform, DonutModelPLModule, DonutDataset
-
-
-os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+from model import train_transform, DonutModelPLModule, DonutDataset, DraftDistillPLModule
+from model import build_draft_model, draft_parity_report
+from model import DynamicPaddingCollator, LengthBucketBatchSampler, ShardedSampler
 
 
 class ProgressBar(pl.callbacks.TQDMProgressBar):
@@ -47,10 +47,14 @@ class PushToHubCallback(Callback):
         self.repo_id = repo_id
 
     def on_train_epoch_end(self, trainer, pl_module):
+        if not trainer.is_global_zero:
+            return
         print(f"Pushing model to the hub, epoch {trainer.current_epoch}")
         pl_module.model.push_to_hub(self.repo_id, commit_message=f"Training in progress, epoch {trainer.current_epoch}")
 
     def on_train_end(self, trainer, pl_module):
+        if not trainer.is_global_zero:
+            return
         print(f"Pushing model to the hub after training end")
         pl_module.processor.push_to_hub(self.repo_id, commit_message=f"Training done")
         pl_module.model.push_to_hub(self.repo_id, commit_message=f"Training done")
@@ -69,7 +73,7 @@ def load_pretrained_model(config):
     return tokenizer, model, processor
 
 
-def load_datasets(config, tokenizer, model, processor):
+def build_datasets(config, tokenizer, model, processor):
     dataset = load_dataset(config.dataset_path)
     datasets = dataset['train'].train_test_split(test_size=config.num_validation, seed=config.seed)
     train_dataset = DonutDataset(
@@ -81,7 +85,9 @@ def load_datasets(config, tokenizer, model, processor):
         split="train", 
         task_start_token=config.start_token,
         sort_json_key=config.sort_json_key,
-        transform=train_transform
+        transform=train_transform,
+        cache_dir=config.get("token_cache_dir"),
+        pad_to_max_length=not config.get("dynamic_padding", False)
         )
 
     val_dataset = DonutDataset(
@@ -92,19 +98,88 @@ def load_datasets(config, tokenizer, model, processor):
         max_length=config.max_length,
         split="validation",
         task_start_token=config.start_token,
-        sort_json_key=config.sort_json_key
+        sort_json_key=config.sort_json_key,
+        cache_dir=config.get("token_cache_dir"),
+        pad_to_max_length=not config.get("dynamic_padding", False)
         )
 
     model.decoder.resize_token_embeddings(len(tokenizer))
     model.config.decoder_start_token_id = tokenizer.convert_tokens_to_ids([config.start_token])[0]
+    return train_dataset, val_dataset
+
+
+def build_dataloader(config, dataset, batch_size, shuffle, num_workers=None):
+    num_workers = config.get("num_workers", 0) if num_workers is None else num_workers
+    loader_kwargs = {}
+    if num_workers > 0:
+        loader_kwargs = {
+            "persistent_workers": config.get("persistent_workers", True),
+            "prefetch_factor": config.get("prefetch_factor", 2),
+        }
+    if config.get("dynamic_padding", False):
+        loader_kwargs["collate_fn"] = DynamicPaddingCollator(dataset.ignore_id, max_length=dataset.max_length)
+    if config.get("length_bucketing", False) and shuffle:
+        loader_kwargs["batch_sampler"] = LengthBucketBatchSampler(dataset.token_lengths(), batch_size, seed=config.seed)
+    else:
+        # the sampler reads the world size from the process group when iterated, so devices: auto, -1 or a list
+        # shard correctly and a single process gets every sample
+        loader_kwargs.update(batch_size=batch_size, sampler=ShardedSampler(len(dataset), shuffle=shuffle, seed=config.seed))
+    return DataLoader(
+        dataset,
+        num_workers=num_workers,
+        pin_memory=config.get("pin_memory", False) and torch.cuda.is_available(),
+        **loader_kwargs,
+    )
 
-    train_dataloader = DataLoader(train_dataset, batch_size=config.train_batch_size, shuffle=True, num_workers=0)
-    val_dataloader = DataLoader(val_dataset, batch_size=config.val_batch_size, shuffle=False, num_workers=0)
+
+def load_datasets(config, tokenizer, model, processor):
+    train_dataset, val_dataset = build_datasets(config, tokenizer, model, processor)
+    train_dataloader = build_dataloader(config, train_dataset, config.train_batch_size, shuffle=True)
+    val_dataloader = build_dataloader(config, val_dataset, config.val_batch_size, shuffle=False)
     return train_dataloader, val_dataloader
 
 
-def save_model(model, processor, tokenizer, save_path):
-    model.save_pretrained(save_path, save_config=True, state_dict=model.state_dict())
+def build_strategy(config):
+    strategy = config.get("strategy", "auto")
+    # gloo lets the same config run as several local CPU processes, nccl stays the default on GPUs
+    backend = config.get("process_group_backend")
+    if strategy == "ddp":
+        return DDPStrategy(process_group_backend=backend, find_unused_parameters=config.get("find_unused_parameters", False))
+    if strategy == "fsdp":
+        from transformers.models.mbart.modeling_mbart import MBartDecoderLayer
+        from transformers.models.donut.modeling_donut_swin import DonutSwinLayer
+        return FSDPStrategy(process_group_backend=backend, auto_wrap_policy={MBartDecoderLayer, DonutSwinLayer})
+    return strategy
+
+
+def build_trainer(config, logger, callbacks):
+    return pl.Trainer(
+            accelerator=config.get("accelerator", "gpu"),
+            devices=config.get("devices", 1),
+            num_nodes=config.get("num_nodes", 1),
+            strategy=build_strategy(config),
+            # build_dataloader already shards across ranks
+            use_distributed_sampler=False,
+            accumulate_grad_batches=config.get("accumulate_grad_batches", 1),
+            max_epochs=config.get("max_epochs"),
+            val_check_interval=config.get("val_check_interval"),
+            check_val_every_n_epoch=config.get("check_val_every_n_epoch"),
+            gradient_clip_val=config.get("gradient_clip_val"),
+            precision=config.get("precision", 16),
+            num_sanity_val_steps=0,
+            logger=logger,
+            callbacks=callbacks,
+    )
+
+
+def full_state_dict(trainer):
+    # gathers FSDP shards (collective, so every rank calls it), strips the LightningModule prefix
+    state_dict = trainer.strategy.lightning_module_state_dict()
+    return {key[len("model."):]: value for key, value in state_dict.items() if key.startswith("model.")}
+
+
+def save_model(model, processor, tokenizer, save_path, state_dict=None):
+    model.save_pretrained(save_path, save_config=True, state_dict=state_dict if state_dict is not None else model.state_dict())
     processor.save_pretrained(save_path)
     tokenizer.save_pretrained(save_path)
     model.config.save_pretrained(save_path)
@@ -116,8 +191,7 @@ def train(config):
 
     torch.cuda.empty_cache()
     model_module = DonutModelPLModule(config, model, tokenizer, data_loaders)
-    if config.wandb:
-        wandb_logger = WandbLogger(project=config.exp_name, name=config.exp_version)
+    wandb_logger = WandbLogger(project=config.exp_name, name=config.exp_version) if config.wandb else None
 
     lr_callback = LearningRateMonitor(logging_interval="step")
     early_stop_callback = EarlyStopping(monitor="val_edit_distance", patience=3, verbose=False, mode="min")
@@ -126,21 +200,53 @@ def train(config):
     if config.repo_id:
         callbacks.append(PushToHubCallback(config.repo_id))
 
-    trainer = pl.Trainer(
-            accelerator="gpu",
-            devices=1,
-            max_epochs=config.get("max_epochs"),
-            val_check_interval=config.get("val_check_interval"),
-            check_val_every_n_epoch=config.get("check_val_every_n_epoch"),
-            gradient_clip_val=config.get("gradient_clip_val"),
-            precision=16,
-            num_sanity_val_steps=0,
-            logger=wandb_logger,
-            callbacks=callbacks,
-    )
+    trainer = build_trainer(config, wandb_logger, callbacks)
+    trainer.fit(model_module)
+    state_dict = full_state_dict(trainer)
+    if trainer.is_global_zero:
+        save_model(model, processor, tokenizer, save_path=config.save_path, state_dict=state_dict)
 
+def build_cache(config):
+    assert config.get("token_cache_dir"), "set token_cache_dir in the config"
+    tokenizer, model, processor = load_pretrained_model(config)
+    train_dataset, val_dataset = build_datasets(config, tokenizer, model, processor)
+    # the validation split is never augmented, so its pixel values can be cached as well
+    for dataset, with_pixel_values in ((train_dataset, False), (val_dataset, True)):
+        if dataset.cache is None:
+            dataset.write_cache(with_pixel_values=with_pixel_values)
+            print(f"wrote {dataset.cache_path}")
+
+
+def distill_draft(config):
+    tokenizer, teacher, processor = load_pretrained_model(config)
+    train_dataloader, val_dataloader = load_datasets(config, tokenizer, teacher, processor)
+    draft = build_draft_model(teacher, config.draft_decoder_layers)
+
+    torch.cuda.empty_cache()
+    model_module = DraftDistillPLModule(config, draft, teacher, tokenizer, (train_dataloader, val_dataloader))
+    logger = WandbLogger(project=config.exp_name, name=config.exp_version) if config.wandb else None
+    callbacks = [
+        EarlyStopping(monitor="val_loss", patience=3, verbose=False, mode="min"),
+        ProgressBar(config),
+        LearningRateMonitor(logging_interval="step"),
+    ]
+
+    trainer = build_trainer(config, logger, callbacks)
     trainer.fit(model_module)
-    save_model(model, processor, tokenizer, save_path=config.save_path)
+    state_dict = full_state_dict(trainer)
+    if not trainer.is_global_zero:
+        return
+    save_model(draft, processor, tokenizer, save_path=config.save_path, state_dict=state_dict)
+    if config.get("strategy") == "fsdp":
+        # the draft's parameters are still sharded across ranks, run draft_parity_report on the saved checkpoint instead
+        return
+
+    teacher.to(trainer.strategy.root_device)
+    draft.to(trainer.strategy.root_device)
+    report = draft_parity_report(teacher, draft, val_dataloader, tokenizer, config.max_length)
+    print(json.dumps(report, indent=2))
+    with open(os.path.join(config.save_path, "parity_report.json"), "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
 
 # python train.py --config config/problems.yaml \
 #                 --pretrained_model_name_or_path "facebook/nougat-base" \
@@ -149,6 +255,27 @@ def train(config):
 #                 --save_path "path/to/save" \
 #                 --repo_id "huggingface/push/repo" \
 #                 --wandb True
+#
+# draft decoder for assisted decoding, distilled from a trained checkpoint
+# python train.py --config config/draft.yaml --mode distill_draft \
+#                 --pretrained_model_name_or_path "path/to/trained/model" \
+#                 --processor_name_or_path "path/to/trained/model" \
+#                 --dataset_path "path/to/dataset" \
+#                 --save_path "path/to/save/draft"
+#
+# pre-tokenized cache, picked up by later runs with the same config and tokenizer
+# python train.py --config config/problems.yaml --mode build_cache \
+#                 --pretrained_model_name_or_path "facebook/nougat-base" \
+#                 --processor_name_or_path "naver-clova-ix/donut-base" \
+#                 --dataset_path "path/to/dataset" \
+#                 --save_path "path/to/save"
+#
+# distributed data parallel, e.g. 2 nodes x 4 GPUs (run on every node with MASTER_ADDR, MASTER_PORT and NODE_RANK set)
+# python train.py --config config/problems.yaml ... --devices 4 --num_nodes 2 --strategy ddp --accumulate_grad_batches 2
+#
+# the same code path on CPU, as 2 local gloo processes
+# python train.py --config config/problems.yaml ... --accelerator cpu --devices 2 --strategy ddp \
+#                 --process_group_backend gloo --precision 32 --num_workers 0
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -160,6 +287,7 @@ if __name__ == "__main__":
     parser.add_argument("--repo_id", type=str, required=False)
     parser.add_argument("--wandb", type=bool, required=False)
     parser.add_argument("--exp_version", type=str, required=False)
+    parser.add_argument("--mode", type=str, default="train", choices=["train", "distill_draft", "build_cache"])
     args, left_argv = parser.parse_known_args()
 
     config = Config(args.config)
@@ -176,4 +304,9 @@ if __name__ == "__main__":
         config.exp_name = basename(args.config).split(".")[0]
         config.exp_version = datetime.datetime.now().strftime("%Y%m%d_%H%M%S") if not args.exp_version else args.exp_version
 
-    train(config)
\ No newline at end of file
+    if args.mode == "distill_draft":
+        distill_draft(config)
+    elif args.mode == "build_cache":
+        build_cache(config)
+    else:
+        train(config)
\ No newline at end of file
@@ -1,13 +1,30 @@
 import re
+import time
 import torch
+import threading
 import numpy as np
 from PIL import Image
+from types import SimpleNamespace
+from collections import deque
+from contextlib import nullcontext
 from dataset.hwp import create_uuid_key
 from optimum.onnxruntime import ORTModelForVision2Seq
+from transformers import LogitsProcessorList
+from transformers.modeling_outputs import BaseModelOutput
 from dataset.pdf_to_image import aspect_ratio_preserving_resize_and_crop
 from transformers import DonutProcessor, VisionEncoderDecoderModel, VisionEncoderDecoderConfig
 
 from EquationStyler import add_backtick
+from inference.utils import content_hash
+from inference.streaming import TokenQueueStreamer, IncrementalDecoder
+from inference.grammar import DonutGrammarLogitsProcessor
+from inference.profiling import DecoderStepTimer, profile_stage
+from inference.preprocess import TensorPreprocessor
+from inference.stopping import build_stopping_criteria, token_budgets, close_open_tags
+from inference.memory import KVCacheEstimator, MemoryPlanner, PeakMemoryMonitor, past_key_values_bytes
+from inference.modes import apply_inference_mode
+from inference.startup import has_safetensors
+from inference.page import detect_problem_boxes, crop_boxes
 
 
 def check_only_eqn(s):
@@ -107,49 +124,295 @@ def make_hwp_text(hwp, contents):
         hwp.hwp.HAction.Run("BreakPara")
 
 
+class DroppedEncoder(torch.nn.Module):
+    """
+    Stands in for the encoder of a model that is only ever called with encoder_outputs.
+    generate still reads encoder.main_input_name and VisionEncoderDecoderModel.forward encoder.config.
+    """
+
+    main_input_name = "pixel_values"
+
+    def __init__(self, config):
+        super().__init__()
+        self.config = config
+
+    def forward(self, pixel_values=None, **kwargs):
+        raise RuntimeError("the encoder was dropped, pass encoder_outputs instead")
+
+
 class Image2Text:
-    def __init__(self, model_path, device):
+    def __init__(
+        self,
+        model_path,
+        device,
+        encoder_cache=None,
+        result_store=None,
+        draft_model_path=None,
+        constrained_decoding=False,
+        profiler=None,
+        tensor_preprocessing=False,
+        reuse_buffers=False,
+        ort_config=None,
+        early_exit=False,
+        length_predictor=None,
+        memory_budget_mb=None,
+        precision="fp32",
+        compile=False,
+        channels_last=False,
+        fast_startup=False,
+    ):
         self.device = device
         self.model_path = model_path
+        self.ort_config = ort_config
+        self.fast_startup = fast_startup
+        self.startup_times = {}
+        self.early_exit = early_exit
+        self.length_predictor = length_predictor
+        self.encoder_cache = encoder_cache
+        self.result_store = result_store
+        self.profiler = profiler
+        self.step_timer = DecoderStepTimer(profiler) if profiler is not None else None
+        started_at = time.perf_counter()
         self.model, self.processor = self.load_model(self.model_path)
+        self.startup_times['load_model'] = time.perf_counter() - started_at
+        if isinstance(self.model, VisionEncoderDecoderModel):
+            apply_inference_mode(self.model, self.device, precision=precision, compile=compile, channels_last=channels_last)
+        self.draft_model = self.load_draft_model(draft_model_path) if draft_model_path else None
         self.decoder_input_ids = torch.tensor([[self.model.config.decoder_start_token_id]]).to(self.device)
+        self.grammar = DonutGrammarLogitsProcessor(self.processor.tokenizer) if constrained_decoding else None
+        # everything that changes the decoded output has to be part of the result-store key
+        self.result_settings = {
+            'max_length': 2048,
+            'constrained_decoding': constrained_decoding,
+            'early_exit': early_exit,
+            'precision': precision,
+            'compile': compile,
+            'channels_last': channels_last,
+        }
+        self.memory_planner = None
+        self.memory_reports = deque(maxlen=1000)
+        if memory_budget_mb is not None:
+            self.memory_planner = MemoryPlanner(KVCacheEstimator(self.model.config), memory_budget_mb * 1024 ** 2)
+        self.preprocessor = None
+        if tensor_preprocessing:
+            self.preprocessor = TensorPreprocessor.from_processor(self.processor, device=self.device, reuse_buffers=reuse_buffers)
 
     def load_model(self, model_path):        
         config = VisionEncoderDecoderConfig.from_pretrained(model_path)
         processor = DonutProcessor.from_pretrained(model_path)
 
         if ('onnx' in model_path) or ('quantized'in model_path):
-            model = ORTModelForVision2Seq.from_pretrained(model_path, use_cache=True, config=config).to(self.device)
+            if self.ort_config is not None:
+                ort_model_path, ort_kwargs = self.ort_config.from_pretrained_kwargs(model_path)
+                model = ORTModelForVision2Seq.from_pretrained(ort_model_path, use_cache=True, config=config, **ort_kwargs)
+            else:
+                model = ORTModelForVision2Seq.from_pretrained(model_path, use_cache=True, config=config).to(self.device)
         else:
-            model = VisionEncoderDecoderModel.from_pretrained(model_path, config=config).to(self.device)
+            if self.fast_startup and has_safetensors(model_path):
+                # memory-map the safetensors weights straight into the model instead of initializing it first
+                model = VisionEncoderDecoderModel.from_pretrained(
+                    model_path, config=config, use_safetensors=True, low_cpu_mem_usage=True
+                ).to(self.device)
+            else:
+                model = VisionEncoderDecoderModel.from_pretrained(model_path, config=config).to(self.device)
             model.eval()
         return model, processor
 
+    def load_draft_model(self, draft_model_path, num_assistant_tokens=5):
+        if not isinstance(self.model, VisionEncoderDecoderModel):
+            raise ValueError("assisted decoding is only supported with the PyTorch model")
+        draft_model = VisionEncoderDecoderModel.from_pretrained(draft_model_path).to(self.device)
+        draft_model.eval()
+        # the draft is distilled with a frozen copy of the full encoder, so share it instead of keeping two
+        draft_model.encoder = self.model.encoder
+        draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+        return draft_model
+
+    def drop_encoder(self):
+        # for callers that always pass encoder_outputs, e.g. the decoder workers of SplitPipeline
+        if self.draft_model is not None:
+            raise ValueError("the draft model shares the encoder, it can not be dropped")
+        if not isinstance(self.model, VisionEncoderDecoderModel):
+            # ORTModel also holds the encoder session as its main session, point that at the decoder session instead
+            self.model.model = self.model.decoder.session
+        self.model.encoder = DroppedEncoder(self.model.config.encoder)
+
+    def stage(self, name, **fields):
+        return profile_stage(self.profiler, name, **fields)
+
+    def open_img(self, img_path, width=480, height=480):
+        with self.stage('open'):
+            if type(img_path) == np.ndarray:
+                image = Image.fromarray(img_path)
+            else:
+                image = Image.open(img_path)
+                image.load()
+        with self.stage('resize'):
+            return aspect_ratio_preserving_resize_and_crop(image, target_width=width, target_height=height)
+
     def load_img(self, img_path, width=480, height=480):
-        if type(img_path) == np.ndarray:
-            image = Image.fromarray(img_path)
-        else:
-            image = Image.open(img_path)
-        image = aspect_ratio_preserving_resize_and_crop(image, target_width=width, target_height=height)
-        img = self.processor(image.convert("RGB"), return_tensors="pt", size=(width, height)).pixel_values
-        pixel_values = img.to(self.device)
+        if self.preprocessor is not None:
+            images, pixel_values = self.load_imgs([img_path])
+            # callers collect several load_img results before torch.cat, so never hand out a view of the shared buffer
+            return images[0], pixel_values.clone() if self.preprocessor.reuse_buffers else pixel_values
+
+        image = self.open_img(img_path, width=width, height=height)
+        with self.stage('processor'):
+            img = self.processor(image.convert("RGB"), return_tensors="pt", size=(width, height)).pixel_values
+            pixel_values = img.to(self.device)
         return image, pixel_values
 
-    def generate(self, pixel_values, num_beams):
-        outputs = self.model.generate(
-                pixel_values,
+    def load_imgs(self, img_paths):
+        if self.preprocessor is None:
+            loaded = [self.load_img(img_path) for img_path in img_paths]
+            return [image for image, _ in loaded], torch.cat([pixel_values for _, pixel_values in loaded])
+        # with reuse_buffers the returned tensor is overwritten by the next call
+        with self.stage('preprocess', batch_size=len(img_paths)):
+            return self.preprocessor(img_paths)
+
+    def encode(self, pixel_values):
+        keys = [content_hash(row) for row in pixel_values]
+        states = {key: self.encoder_cache.get(key) for key in set(keys)}
+        missing = [idx for idx, key in enumerate(keys) if states[key] is None]
+        if missing:
+            with torch.no_grad():
+                hidden_states = self.model.get_encoder()(pixel_values=pixel_values[missing]).last_hidden_state
+            for idx, state in zip(missing, hidden_states):
+                # a row view would keep the whole batch's storage alive behind a single row's byte count
+                state = state.clone()
+                states[keys[idx]] = state
+                self.encoder_cache.put(keys[idx], state)
+        return BaseModelOutput(last_hidden_state=torch.stack([states[key] for key in keys]))
+
+    def logits_processor(self):
+        processors = [processor for processor in (self.grammar, self.step_timer) if processor is not None]
+        return LogitsProcessorList(processors) if processors else None
+
+    def result_key_settings(self):
+        settings = dict(self.result_settings)
+        if self.early_exit and self.length_predictor is not None:
+            # token budgets follow the predictor, which is refitted as history accumulates
+            predictor = self.length_predictor
+            settings['length_budget'] = [float(predictor.intercept), float(predictor.slope), predictor.ink_threshold]
+        return settings
+
+    def stopping_criteria(self, pixel_values=None):
+        budgets = None
+        if self.length_predictor is not None and pixel_values is not None:
+            image_processor = self.processor.image_processor
+            budgets = token_budgets(pixel_values, image_processor.image_mean, image_processor.image_std, self.length_predictor)
+        return build_stopping_criteria(self.processor.tokenizer, budgets=budgets)
+
+    def assisted_generate(self, pixel_values, **kwargs):
+        if self.draft_model is None:
+            raise ValueError("assisted decoding needs a draft model, pass draft_model_path to Image2Text")
+
+        # assisted generation only runs greedy with a single row, so the batch is decoded row by row
+        sequences = []
+        for row in pixel_values.split(1):
+            if self.encoder_cache is not None:
+                encoder_outputs = self.encode(row)
+            else:
+                with torch.no_grad():
+                    encoder_outputs = self.model.get_encoder()(pixel_values=row)
+            outputs = self.model.generate(
+                encoder_outputs=encoder_outputs,
+                assistant_encoder_outputs=encoder_outputs,
+                assistant_model=self.draft_model,
                 decoder_input_ids=self.decoder_input_ids,
                 max_length=2048,
+                pad_token_id=self.processor.tokenizer.pad_token_id,
+                eos_token_id=self.processor.tokenizer.eos_token_id,
+                use_cache=True,
+                num_beams=1,
+                bad_words_ids=[[self.processor.tokenizer.unk_token_id]],
+                logits_processor=self.logits_processor(),
+                return_dict_in_generate=True,
+                **kwargs,
+            )
+            sequences.append(outputs.sequences[0])
+
+        sequences = torch.nn.utils.rnn.pad_sequence(
+            sequences, batch_first=True, padding_value=self.processor.tokenizer.pad_token_id
+        )
+        return SimpleNamespace(sequences=sequences)
+
+    def generate(self, pixel_values, num_beams, assisted=False, encoder_outputs=None, **kwargs):
+        batch_size = pixel_values.shape[0] if encoder_outputs is None else encoder_outputs.last_hidden_state.shape[0]
+        if assisted:
+            with self.stage('decoder', batch_size=batch_size, num_beams=1, assisted=True):
+                return self.assisted_generate(pixel_values, **kwargs)
+
+        decoder_input_ids = self.decoder_input_ids.repeat(batch_size, 1)
+        if encoder_outputs is not None:
+            inputs = {'encoder_outputs': encoder_outputs}
+        elif self.encoder_cache is not None:
+            with self.stage('encoder', batch_size=batch_size):
+                inputs = {'encoder_outputs': self.encode(pixel_values)}
+        elif self.profiler is not None:
+            # run the encoder on its own so its time is not folded into the decoder stage
+            with self.stage('encoder', batch_size=batch_size), torch.no_grad():
+                inputs = {'encoder_outputs': self.model.get_encoder()(pixel_values=pixel_values)}
+        else:
+            inputs = {'pixel_values': pixel_values}
+
+        if self.early_exit and 'stopping_criteria' not in kwargs:
+            kwargs['stopping_criteria'] = self.stopping_criteria(pixel_values)
+        if self.step_timer is not None:
+            self.step_timer.reset()
+        monitor = PeakMemoryMonitor(self.device) if self.memory_planner is not None else nullcontext()
+        with self.stage('decoder', batch_size=batch_size, num_beams=num_beams), monitor:
+            outputs = self.model.generate(
+                **inputs,
+                decoder_input_ids=decoder_input_ids,
+                max_length=2048,
                 early_stopping=True,
                 pad_token_id=self.processor.tokenizer.pad_token_id,
                 eos_token_id=self.processor.tokenizer.eos_token_id,
                 use_cache=True,
                 num_beams=num_beams,
                 bad_words_ids=[[self.processor.tokenizer.unk_token_id]],
+                logits_processor=self.logits_processor(),
                 return_dict_in_generate=True,
+                **kwargs,
             )
+        if self.memory_planner is not None:
+            self.report_memory(monitor, outputs, batch_size, num_beams)
         return outputs
 
+    def report_memory(self, monitor, outputs, batch_size, num_beams):
+        estimator = self.memory_planner.estimator
+        report = {
+            "batch_size": batch_size,
+            "num_beams": num_beams,
+            "estimated_peak": estimator.estimate(batch_size, num_beams, self.memory_planner.max_length)["total"],
+            "estimated_at_length": estimator.estimate(batch_size, num_beams, outputs.sequences.shape[1])["total"],
+            "actual_peak": monitor.peak_delta,
+            "actual_kv_cache": past_key_values_bytes(getattr(outputs, "past_key_values", None)),
+            "budget": self.memory_planner.budget_bytes,
+        }
+        self.memory_reports.append(report)
+        return report
+
+    def warmup(self, batch_sizes=(1,), num_beams=(1,), max_new_tokens=8):
+        # a blank page exercises the same kernels (and torch.compile graphs, ORT sessions, tokenizer) as a real request
+        blank = np.full((480, 480, 3), 255, dtype=np.uint8)
+        started_at = time.perf_counter()
+        _, pixel_values = self.load_img(blank)
+        timings = {'preprocess': time.perf_counter() - started_at}
+        for batch_size in batch_sizes:
+            for beams in num_beams:
+                started_at = time.perf_counter()
+                outputs = self.generate(pixel_values.repeat(batch_size, 1, 1, 1), beams, max_new_tokens=max_new_tokens)
+                timings[(batch_size, beams)] = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        # the blank page decodes to nothing token2json can parse, only the tokenizer warm-up matters here
+        self.batch_postprocessing(outputs, raise_errors=False)
+        timings['postprocessing'] = time.perf_counter() - started_at
+        self.startup_times['warmup'] = sum(timings.values())
+        return timings
+
     def correct_latex_expressions(self, text):
         corrected_text = re.sub(r'\$(.*?)\$?\s*([가-힣])', r'$\1$\2', text)
         return corrected_text
@@ -178,17 +441,94 @@ class Image2Text:
             # corrected_lines.append(line)
         return corrected_lines
 
-    def postprocessing(self, outputs):
-        seq = self.processor.batch_decode(outputs.sequences)[0]
+    def decode_sequence(self, seq):
         seq = seq.replace(self.processor.tokenizer.eos_token, "").replace(self.processor.tokenizer.pad_token, "")
         seq = re.sub(r"<.*?>", "", seq, count=1).strip()  
-        seq = self.processor.token2json(seq)
+        seq = close_open_tags(seq)
+        with self.stage('token2json'):
+            seq = self.processor.token2json(seq)
         contents = seq['content'].split('[newline]')
         # contents = self.correct_math_expressions(contents)
         return seq, contents
 
-    def get_text(self, img_path, num_beams=16):
+    def postprocessing(self, outputs):
+        return self.batch_postprocessing(outputs)[0]
+
+    def batch_postprocessing(self, outputs, raise_errors=True):
+        with self.stage('batch_decode', batch_size=len(outputs.sequences)):
+            seqs = self.processor.batch_decode(outputs.sequences)
+        results = []
+        for seq in seqs:
+            try:
+                results.append(self.decode_sequence(seq))
+            except Exception as e:
+                if raise_errors:
+                    raise
+                # one malformed row must not discard the rest of the batch, it comes back as (error, None)
+                results.append((e, None))
+        return results
+
+    def get_text(self, img_path, num_beams=16, assisted=False):
+        if assisted:
+            num_beams = 1
+        if self.memory_planner is not None:
+            _, num_beams = self.memory_planner.plan(1, num_beams)
+        if self.result_store is not None:
+            key = self.result_store.make_key(img_path, num_beams=num_beams, **self.result_key_settings())
+            cached = self.result_store.get(key)
+            if cached is not None:
+                seq, content = cached
+                return content, self.open_img(img_path), seq
+
         image, pixel_values = self.load_img(img_path)
-        outputs = self.generate(pixel_values, num_beams)
+        outputs = self.generate(pixel_values, num_beams, assisted=assisted)
         seq, content = self.postprocessing(outputs)
+
+        if self.result_store is not None:
+            self.result_store.put(key, seq, content)
         return content, image, seq
+
+    def stream_text(self, img_path):
+        image, pixel_values = self.load_img(img_path)
+        streamer = TokenQueueStreamer()
+        result = {}
+
+        def run():
+            try:
+                result['outputs'] = self.generate(pixel_values, num_beams=1, streamer=streamer)
+            except Exception as e:
+                result['error'] = e
+                streamer.end()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        decoder = IncrementalDecoder(self.processor.tokenizer)
+        for token_ids in streamer:
+            if decoder.feed(token_ids):
+                yield decoder.contents, image, None
+        thread.join()
+
+        if 'error' in result:
+            raise result['error']
+        seq, content = self.postprocessing(result['outputs'])
+        yield content, image, seq
+
+    def get_texts(self, img_paths, batch_size=8, num_beams=16, assisted=False):
+        # rows that fail to decode are returned as (None, image, error) instead of failing the batch
+        if self.memory_planner is not None and not assisted:
+            batch_size, num_beams = self.memory_planner.plan(batch_size, num_beams)
+        results = []
+        for start in range(0, len(img_paths), batch_size):
+            images, pixel_values = self.load_imgs(img_paths[start:start + batch_size])
+            outputs = self.generate(pixel_values, num_beams, assisted=assisted)
+            for image, (seq, content) in zip(images, self.batch_postprocessing(outputs, raise_errors=False)):
+                results.append((content, image, seq))
+        return results
+
+    def get_page_texts(self, page_img, batch_size=8, num_beams=16, **detect_kwargs):
+        with self.stage('layout'):
+            boxes = detect_problem_boxes(page_img, **detect_kwargs)
+            crops = crop_boxes(page_img, boxes)
+        # every crop is letterboxed to 480x480 by open_img, so the whole page goes through one batched pass
+        results = self.get_texts(crops, batch_size=batch_size, num_beams=num_beams)
+        return [(box, content, seq) for box, (content, _, seq) in zip(boxes, results)]